@@ -0,0 +1,148 @@
+"""
+async_sync.py - Asyncio orchestration mode for Plexify
+
+This module runs a sync cycle with asyncio instead of processing playlists one
+after another. Every playlist moves through the same stages as the synchronous
+path (Spotify paging, filesystem check, YouTube search, download, Plex cleanup),
+but playlists progress concurrently and each stage has its own concurrency
+limit. The blocking stage functions from plex_utils/utils run in worker threads,
+so the existing per-host rate limiters still apply to every request.
+
+Enabled with SYNC_MODE=async.
+
+Key classes/functions:
+- StageLimits: Per-stage concurrency limits (Spotify, search, download, Plex)
+- runSyncAsync: Async counterpart of utils.runSync
+- syncPlaylistAsync: Runs one playlist through all stages
+"""
+
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+from utils import refreshPlaylists, save_cached_playlists
+from content_store import get_content_store
+from config import RuntimeConfig, get_runtime_config
+from plex_utils import (fetchPlaylistTracks, planLocalFiles, search_queued_track, groupDownloadBatches,
+                        _download_batch, search_workers, download_workers, plex_workers)
+
+class StageLimits:
+    """
+    One asyncio semaphore per pipeline stage. Must be created inside the running event loop.
+    """
+    def __init__(self, spotify: int = 2, search: int = 4, download: int = 4, plex: int = 2):
+        self.sizes = {'spotify': spotify, 'search': search, 'download': download, 'plex': plex}
+        self.spotify = asyncio.Semaphore(spotify)
+        self.search = asyncio.Semaphore(search)
+        self.download = asyncio.Semaphore(download)
+        self.plex = asyncio.Semaphore(plex)
+
+    @classmethod
+    def from_env(cls) -> 'StageLimits':
+        return cls(
+            spotify=max(1, int(os.environ.get('SPOTIFY_CONCURRENCY', '2'))),
+            search=search_workers,
+            download=download_workers,
+            plex=plex_workers,
+        )
+
+    @property
+    def total(self) -> int:
+        return sum(self.sizes.values())
+
+async def syncPlaylistAsync(sp, playlist: Dict, limits: StageLimits, plex_stage: Optional[Callable[[Dict], bool]] = None,
+                            config: RuntimeConfig = None) -> bool:
+    """
+    Runs one playlist through the Spotify, filesystem, search, download and (optionally)
+    Plex stages. Returns True if the cached playlist changed and should be saved.
+    """
+    config = config or get_runtime_config()
+    musicPath = config.music_path
+    playlistName = playlist.get('name', 'Unknown Playlist')
+    previous_tracks = playlist.get('local_tracks') or {}
+
+    if not musicPath:
+        logging.error("❌ MUSIC_PATH environment variable not set.")
+    else:
+        logging.info(f"📁 Ensuring local files for playlist: {playlistName}")
+        async with limits.spotify:
+            tracks = await asyncio.to_thread(fetchPlaylistTracks, sp, playlist)
+
+        index, local_tracks, download_queue = await asyncio.to_thread(planLocalFiles, musicPath, playlist, tracks, config)
+
+        if download_queue:
+            async def search(job):
+                async with limits.search:
+                    return await asyncio.to_thread(search_queued_track, job)
+
+            store = get_content_store(musicPath)
+
+            async def download(batch):
+                async with limits.download:
+                    return await asyncio.to_thread(_download_batch, index, batch, store, config)
+
+            logging.info(f"▶️  Resolving {len(download_queue)} YouTube searches for '{playlistName}'...")
+            youtube_urls = await asyncio.gather(*(search(job) for _, job in download_queue))
+
+            batches = groupDownloadBatches(download_queue, youtube_urls)
+            logging.info(f"⬇️  Downloading {len(download_queue)} missing tracks for '{playlistName}' in {len(batches)} batches...")
+            for results in await asyncio.gather(*(download(batch) for batch in batches)):
+                for track_id, downloaded_path in results:
+                    if downloaded_path and track_id:
+                        local_tracks[track_id] = downloaded_path
+            logging.info(f"✅ Completed downloading {len(download_queue)} tracks for '{playlistName}'")
+        else:
+            logging.info(f"✨ All tracks already present for playlist: {playlistName}")
+
+        playlist['local_tracks'] = local_tracks
+
+    changed = (playlist.get('local_tracks') or {}) != previous_tracks
+    if plex_stage:
+        async with limits.plex:
+            # A truthy result means the stage updated the cached playlist
+            changed |= bool(await asyncio.to_thread(plex_stage, playlist))
+
+    return changed
+
+async def runSyncAsync(sp, spotify_uris: List[Dict], force_refresh: bool = False,
+                       plex_stage: Optional[Callable[[Dict], bool]] = None, limits: StageLimits = None,
+                       config: RuntimeConfig = None) -> List[Dict]:
+    """
+    Async sync cycle. Playlists are synced concurrently, bounded per stage by limits
+    (StageLimits.from_env() by default). plex_stage, if given, is called with each
+    playlist once its downloads are done and returns True if it changed the playlist.
+    Returns the synced playlists like runSync.
+    """
+    logging.info("🔄 Starting synchronization process (async mode)...")
+    limits = limits or StageLimits.from_env()
+    config = config or get_runtime_config()
+
+    # Stage limits are enforced before work reaches the pool, so this only needs to fit them all
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=limits.total + 1, thread_name_prefix='async-sync')
+    loop.set_default_executor(executor)
+
+    async with limits.spotify:
+        spotifyPlaylists = await asyncio.to_thread(refreshPlaylists, sp, spotify_uris, force_refresh)
+
+    if not spotifyPlaylists:
+        logging.info("✨ No playlists to sync.")
+        return spotifyPlaylists
+
+    results = await asyncio.gather(
+        *(syncPlaylistAsync(sp, playlist, limits, plex_stage, config) for playlist in spotifyPlaylists),
+        return_exceptions=True,
+    )
+
+    changed = False
+    for playlist, result in zip(spotifyPlaylists, results):
+        if isinstance(result, Exception):
+            logging.error(f"💥 Sync failed for playlist '{playlist.get('name', 'Unknown')}': {result}")
+        else:
+            changed |= result
+
+    if changed:
+        save_cached_playlists(spotifyPlaylists)
+    logging.info("✅ Synchronization process finished.")
+    return spotifyPlaylists
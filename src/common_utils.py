@@ -1,16 +1,24 @@
 """
 common_utils.py - Shared utilities for Plexify
 
-This module provides shared helpers for retry logic and folder creation.
+This module provides shared helpers for retry logic, rate limiting and folder creation.
 
 Key functions:
 - createFolder: Ensure playlist folder exists
+- normalize_for_matching: Normalize names and tags for fuzzy comparisons
 - retry_with_backoff: Retry logic for API calls
+- RetryPolicy: Jittered retries with error classification, time budgets and metrics
+- HostRateLimiter: Thread-safe per-host request spacing
+- TokenBucket: Thread-safe bursting rate limiter that backs off on 429s
 """
 
 import os
 import logging
+import random
+import threading
 import time
+import requests
+from functools import lru_cache
 import spotipy
 
 # Creates a folder for a playlist if it doesn't already exist
@@ -22,25 +30,214 @@ def createFolder(folder_path):
     except Exception as e:
         logging.error(f'Failed to create folder {folder_path}: {e}')
 
-# Retries a function with exponential backoff in case of failures
+# Characters removed by normalize_for_matching: / \ - _ . : ; , ( ) [ ] ' "
+_MATCHING_STRIP_CHARS = '/\\-_.,:;()[]\'"'
+_MATCHING_STRIP_BYTES = _MATCHING_STRIP_CHARS.encode('ascii')
+_MATCHING_STRIP_TABLE = str.maketrans('', '', _MATCHING_STRIP_CHARS)
+
+# Bounded memo for the names and tags that come up again on every scan
+# (a few entries per track of a personal library; each entry is a pair of short strings)
+NORMALIZE_CACHE_SIZE = 16384
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_for_matching(text: str) -> str:
+    """
+    Normalize text for fuzzy matching by removing special characters and converting to lowercase.
+    Handles cases like "AC/DC" -> "acdc", "Ac-Dc" -> "acdc", etc.
+    """
+    if not text:
+        return ""
+    
+    normalized = text.lower()
+    # bytes.translate is a single C table pass; str.translate is slower than
+    # chained replace() on CPython, so it only handles non-ASCII text
+    if normalized.isascii():
+        normalized = normalized.encode('ascii').translate(None, _MATCHING_STRIP_BYTES).decode('ascii')
+    else:
+        normalized = normalized.translate(_MATCHING_STRIP_TABLE)
+    
+    # Remove extra spaces
+    return ' '.join(normalized.split())
+
+class RetryError(Exception):
+    """
+    Raised when a call fails with a fatal error or runs out of attempts/time.
+    The last underlying exception is chained as __cause__.
+    """
+
+# HTTP statuses worth retrying: rate limiting and transient server errors
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+class RetryPolicy:
+    """
+    Retries transient failures with decorrelated jitter backoff.
+    
+    Errors are classified first: HTTP 429/5xx, connection resets and timeouts are
+    retried, anything else (e.g. a 404 for a bad playlist ID) fails immediately.
+    Each call stops retrying once call_budget seconds have passed, and all calls
+    together stop sleeping once their sleeps add up to cycle_budget seconds per cycle.
+    Attempts, retries and time spent sleeping are kept in metrics for the recap.
+    """
+    def __init__(self, max_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 16.0,
+                 call_budget: float = 30.0, cycle_budget: float = 300.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.call_budget = call_budget
+        self.cycle_budget = cycle_budget
+        self._lock = threading.Lock()
+        self.start_cycle()
+
+    def start_cycle(self):
+        """
+        Resets the per-cycle sleep budget and the metrics.
+        """
+        with self._lock:
+            self.metrics = {'calls': 0, 'attempts': 0, 'retries': 0, 'failures': 0, 'sleep_seconds': 0.0}
+
+    def _record(self, key: str, amount=1):
+        with self._lock:
+            self.metrics[key] += amount
+
+    def _reserve_sleep(self, seconds: float) -> bool:
+        # Checked and booked under one lock, so concurrent callers can't overdraw the cycle budget together
+        with self._lock:
+            if self.metrics['sleep_seconds'] + seconds > self.cycle_budget:
+                return False
+            self.metrics['sleep_seconds'] += seconds
+            return True
+
+    @staticmethod
+    def classify(exc: Exception):
+        """
+        Returns (retryable, retry_after) for an exception; retry_after is the server's
+        requested delay in seconds, if any.
+        """
+        if isinstance(exc, spotipy.exceptions.SpotifyException):
+            retry_after = None
+            if exc.http_status == 429 and exc.headers and exc.headers.get('Retry-After'):
+                retry_after = float(exc.headers['Retry-After'])
+            return exc.http_status in RETRYABLE_STATUSES, retry_after
+        if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                            ConnectionError, TimeoutError)):
+            return True, None
+        return False, None
+
+    def call(self, func, *args, **kwargs):
+        self._record('calls')
+        deadline = time.monotonic() + self.call_budget
+        delay = self.base_delay
+        for attempt in range(1, self.max_attempts + 1):
+            self._record('attempts')
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                retryable, retry_after = self.classify(e)
+                if not retryable:
+                    self._record('failures')
+                    raise RetryError(f"{getattr(func, '__name__', 'call')} failed with a non-retryable error: {e}") from e
+                if attempt == self.max_attempts:
+                    self._record('failures')
+                    raise RetryError(f"{getattr(func, '__name__', 'call')} failed after {attempt} attempts: {e}") from e
+
+                # Decorrelated jitter, unless the server told us how long to wait
+                delay = min(self.max_delay, random.uniform(self.base_delay, delay * 3))
+                sleep_for = retry_after if retry_after is not None else delay
+                if time.monotonic() + sleep_for > deadline or not self._reserve_sleep(sleep_for):
+                    self._record('failures')
+                    raise RetryError(f"{getattr(func, '__name__', 'call')} out of retry time after {attempt} attempts: {e}") from e
+
+                logging.debug(f"Retrying {getattr(func, '__name__', 'call')} in {sleep_for:.2f}s after: {e}")
+                self._record('retries')
+                time.sleep(sleep_for)
+
+# Shared by every API call; its cycle budget and metrics are reset with the sync stats
+retry_policy = RetryPolicy(
+    call_budget=float(os.environ.get('RETRY_CALL_BUDGET', '30')),
+    cycle_budget=float(os.environ.get('RETRY_CYCLE_BUDGET', '300')),
+)
+
+# Retries a function on transient failures using the shared retry_policy
 # - func: The function to retry
 # - *args, **kwargs: Arguments and keyword arguments to pass to the function
-# Handles Spotify API rate-limiting errors (HTTP 429) and other transient errors
+# Raises RetryError (chaining the original error) for fatal errors or when retries are exhausted
 def retry_with_backoff(func, *args, **kwargs):
-    max_retries = 5
-    backoff = 1
-
-    for attempt in range(max_retries):
-        try:
-            return func(*args, **kwargs)
-        except spotipy.exceptions.SpotifyException as e:
-            if e.http_status == 429:
-                retry_after = int(e.headers.get("Retry-After", backoff))
-                time.sleep(retry_after)
-                backoff *= 2
-            else:
-                raise e
-        except Exception as e:
-            time.sleep(backoff)
-            backoff *= 2
-    raise Exception("Max retries exceeded")
\ No newline at end of file
+    return retry_policy.call(func, *args, **kwargs)
+
+class HostRateLimiter:
+    """
+    Thread-safe limiter that enforces a minimum interval between requests to the same host.
+    Each caller reserves the next free slot for its host, so concurrent workers are spread
+    out instead of all firing at once.
+    """
+    def __init__(self, min_interval: float):
+        self.min_interval = max(0.0, min_interval)
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    def wait(self, host: str):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, 0.0))
+            self._next_slot[host] = slot + self.min_interval
+        delay = slot - now
+        if delay > 0:
+            logging.debug(f"Rate limiting requests to {host} for {delay:.2f}s")
+            time.sleep(delay)
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by every caller of one API. Allows bursts of up to
+    `burst` calls and refills at `rate` calls per second. Callers reserve a token and
+    sleep outside the lock, so a worker pool is served in arrival order.
+    
+    A 429 pauses all callers until its Retry-After has passed and halves the rate;
+    every successful call then wins back a little of the configured rate.
+    """
+    def __init__(self, rate: float, burst: float):
+        self.max_rate = max(0.01, rate)
+        self.rate = self.max_rate
+        self.burst = max(1.0, burst)
+        # Tokens handed out so far, i.e. API calls made (used for hourly budgets)
+        self.acquired = 0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        # _updated lies in the future while paused; nothing refills until then
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # A negative balance is the queue of callers already waiting for a token
+            self._tokens -= 1
+            self.acquired += 1
+            delay = max(0.0, self._updated - now) + max(0.0, -self._tokens) / self.rate
+        if delay > 0:
+            logging.debug(f"Rate limiting API call for {delay:.2f}s")
+            time.sleep(delay)
+
+    def penalize(self, retry_after: float):
+        """
+        Called on a 429: no tokens are handed out before retry_after seconds have passed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._updated = max(self._updated, now + retry_after)
+            self._tokens = min(self._tokens, 0.0)
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+        logging.warning(f"⚠️  Rate limited, pausing API calls for {retry_after:.1f}s (now {self.rate:.2f} req/s)")
+
+    def reward(self):
+        """
+        Called after a successful request to recover towards the configured rate.
+        """
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
@@ -0,0 +1,66 @@
+"""
+config.py - Runtime configuration for Plexify
+
+This module resolves the settings the sync path consults for every track
+(music path, format preference, downloader log level, ffmpeg location) once,
+into an immutable object that is passed down through runSync instead of being
+re-read from the environment inside the per-track loops.
+
+Key classes/functions:
+- RuntimeConfig: Immutable settings for one process, read from the environment
+- get_runtime_config: Returns the process-wide config, resolving it on first use
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import Mapping, Optional
+
+TRUE_VALUES = ('true', '1', 'yes')
+
+@dataclass(frozen=True)
+class RuntimeConfig:
+    """
+    Settings resolved once at startup. Frozen, so it can be shared by all worker threads.
+    """
+    music_path: Optional[str] = None
+    prefer_flac: bool = True
+    spotdl_log_level: str = 'INFO'
+    ffmpeg_location: Optional[str] = None
+    download_cache_path: str = os.path.join(tempfile.gettempdir(), 'plexify-downloads')
+
+    @classmethod
+    def from_env(cls, environ: Mapping[str, str] = None) -> 'RuntimeConfig':
+        """
+        Reads the config from environ (os.environ by default) and looks up ffmpeg on PATH.
+        """
+        environ = os.environ if environ is None else environ
+        return cls(
+            music_path=environ.get('MUSIC_PATH') or None,
+            prefer_flac=environ.get('PREFER_FLAC', 'true').lower() in TRUE_VALUES,
+            spotdl_log_level=environ.get('SPOTDL_LOG_LEVEL', environ.get('LOG_LEVEL', 'INFO')).upper(),
+            ffmpeg_location=shutil.which('ffmpeg'),
+            download_cache_path=environ.get('DOWNLOAD_CACHE_PATH') or cls.download_cache_path,
+        )
+
+    @property
+    def audio_format(self) -> str:
+        """
+        Preferred download format: 'flac' or 'mp3'.
+        """
+        return 'flac' if self.prefer_flac else 'mp3'
+
+_config = None
+_config_lock = threading.Lock()
+
+def get_runtime_config() -> RuntimeConfig:
+    """
+    Returns the process-wide config, reading the environment on first use.
+    """
+    global _config
+    with _config_lock:
+        if _config is None:
+            _config = RuntimeConfig.from_env()
+        return _config
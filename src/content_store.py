@@ -0,0 +1,189 @@
+"""
+content_store.py - Cross-playlist track store for Plexify
+
+This module keeps one copy of every downloaded track in a content store below
+MUSIC_PATH, keyed by Spotify track ID. When a song is in several playlists it is
+searched for and downloaded once; every other playlist folder receives the
+stored file as a hardlink, reflink or relative symlink, falling back to a plain
+copy when the filesystem supports none of them. The store itself only takes
+hardlinks or reflinks of downloads, so it never costs extra space and never
+depends on a playlist file staying in place.
+
+Key classes/functions:
+- ContentStore: Track-ID keyed store that materializes files into playlist folders
+- get_content_store: Returns the shared store for a music path
+- link_file: Links or copies a file, trying the cheapest method first
+"""
+
+import os
+import logging
+import shutil
+import threading
+from typing import Optional
+from library_index import AUDIO_EXTENSIONS
+
+STORE_DIRNAME = '.plexify_store'
+
+# ioctl request number of Linux' FICLONE (copy-on-write clone on btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_content_store(music_path: str) -> Optional['ContentStore']:
+    """
+    Returns the process-wide store under music_path, or None if CONTENT_STORE is disabled.
+    """
+    if os.environ.get('CONTENT_STORE', 'true').lower() not in ['true', '1', 'yes']:
+        return None
+    with _stores_lock:
+        store = _stores.get(music_path)
+        if store is None:
+            store = ContentStore(os.path.join(music_path, STORE_DIRNAME))
+            _stores[music_path] = store
+        return store
+
+def _reflink(source: str, target: str):
+    import fcntl
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(target)
+            raise
+
+def _symlink(source: str, target: str):
+    # Relative, so the link still resolves when MUSIC_PATH is mounted elsewhere (e.g. in Plex's container)
+    os.symlink(os.path.relpath(source, os.path.dirname(target)), target)
+
+def link_file(source: str, target: str) -> str:
+    """
+    Makes target refer to the same content as source: hardlink, then reflink, then
+    symlink, then a full copy. Returns the method that worked.
+    """
+    for method, link in (('hardlink', os.link), ('reflink', _reflink), ('symlink', _symlink)):
+        try:
+            link(source, target)
+            return method
+        except (OSError, ImportError, NotImplementedError) as e:
+            logging.debug(f"Could not {method} '{source}' -> '{target}': {e}")
+    shutil.copy2(source, target)
+    return 'copy'
+
+class ContentStore:
+    """
+    One file per Spotify track ID, stored as <root>/<2-char prefix>/<track_id>.<ext>.
+    Safe to use from the download worker threads.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _path(self, track_id: str, extension: str) -> str:
+        return os.path.join(self.root, track_id[:2], track_id + extension)
+
+    def lookup(self, track_id: Optional[str]) -> Optional[str]:
+        """
+        Returns the stored file for track_id (FLAC preferred), or None.
+        """
+        if not track_id:
+            return None
+        for extension in AUDIO_EXTENSIONS:
+            path = self._path(track_id, extension)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def add(self, track_id: Optional[str], downloaded_path: str):
+        """
+        Records a freshly downloaded file in the store as a hardlink or reflink. If the
+        filesystem supports neither, the track is not stored: a symlink would break
+        once the playlist file is deleted, and a copy would double the space used.
+        """
+        if not track_id or not downloaded_path or not os.path.isfile(downloaded_path) or self.lookup(track_id):
+            return
+        target = self._path(track_id, os.path.splitext(downloaded_path)[1].lower())
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with self._lock:
+                if not os.path.exists(target):
+                    self._store_link(downloaded_path, target)
+        except OSError as e:
+            logging.warning(f"⚠️  Could not add '{downloaded_path}' to the content store: {e}")
+
+    def _store_link(self, source: str, target: str):
+        for method, link in (('hardlink', os.link), ('reflink', _reflink)):
+            try:
+                link(source, target)
+                return
+            except (OSError, ImportError) as e:
+                logging.debug(f"Could not {method} '{source}' into the content store: {e}")
+        logging.debug(f"Not storing '{source}': the filesystem supports neither hardlinks nor reflinks")
+
+    def materialize(self, track_id: Optional[str], expected_filepath: str) -> Optional[str]:
+        """
+        Places the stored file for track_id at expected_filepath (keeping the stored
+        file's extension). Returns the new path, or None if the track isn't stored.
+        """
+        stored = self.lookup(track_id)
+        if not stored:
+            return None
+        target = os.path.splitext(expected_filepath)[0] + os.path.splitext(stored)[1]
+        if os.path.exists(target):
+            return target
+        try:
+            # A dangling symlink would make the new link fail
+            if os.path.lexists(target):
+                os.remove(target)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            method = link_file(stored, target)
+        except OSError as e:
+            logging.warning(f"⚠️  Could not materialize '{target}' from the content store: {e}")
+            return None
+        logging.info(f"🔗 Reused stored download for '{os.path.basename(target)}' ({method})")
+        return target
+
+    def sweep(self, referenced_ids) -> int:
+        """
+        Removes stored files that no playlist folder holds a copy of anymore (link
+        count 1) and that no cached playlist references. A reflinked file always has
+        a link count of 1, so for reflink stores the references alone decide; a file
+        still referenced is kept either way, since the next sync would place it again.
+        Returns the number of files removed.
+        """
+        referenced_ids = set(referenced_ids)
+        removed = 0
+        try:
+            prefixes = [entry.path for entry in os.scandir(self.root) if entry.is_dir(follow_symlinks=False)]
+        except FileNotFoundError:
+            return 0
+        for prefix in prefixes:
+            with self._lock, os.scandir(prefix) as it:
+                for entry in it:
+                    track_id, extension = os.path.splitext(entry.name)
+                    if extension.lower() not in AUDIO_EXTENSIONS or track_id in referenced_ids:
+                        continue
+                    try:
+                        if entry.stat(follow_symlinks=False).st_nlink == 1:
+                            os.remove(entry.path)
+                            removed += 1
+                    except OSError as e:
+                        logging.warning(f"⚠️  Could not sweep '{entry.path}' from the content store: {e}")
+            try:
+                os.rmdir(prefix)
+            except OSError:
+                pass
+        if removed:
+            logging.info(f"🧹 Removed {removed} unused tracks from the content store")
+        return removed
+
+    def discard(self, track_id: Optional[str]):
+        """
+        Drops a track from the store, e.g. after it was rated 1-star and deleted.
+        Files already placed in playlist folders are not touched.
+        """
+        for extension in AUDIO_EXTENSIONS:
+            path = self._path(track_id, extension) if track_id else None
+            if path and os.path.lexists(path):
+                os.remove(path)
@@ -0,0 +1,293 @@
+"""
+library_index.py - Persistent local library index for Plexify
+
+This module keeps an SQLite index of the audio files below MUSIC_PATH so that
+checking whether a track already exists no longer lists folders and re-reads
+tags on every sync cycle. Entries are keyed by path and carry the file's
+mtime/size plus normalized artist/title, so tags are only read again for files
+that actually changed on disk.
+
+It also provides a per-cycle directory snapshot cache, so each album folder is
+listed at most once per sync cycle unless something writes to it.
+
+Key classes/functions:
+- LibraryIndex: SQLite-backed index of local audio files
+- get_library_index: Returns the shared index for a music path
+- DirectorySnapshotCache: Per-cycle cache of folder listings
+"""
+
+import os
+import logging
+import sqlite3
+import threading
+import mutagen
+from collections import namedtuple
+from typing import Dict, List, Optional
+from common_utils import normalize_for_matching
+
+INDEX_FILENAME = '.plexify_index.sqlite'
+
+# Audio formats tracked by the index, in lookup priority order (FLAC first, then MP3)
+AUDIO_EXTENSIONS = ('.flac', '.mp3')
+
+IndexEntry = namedtuple('IndexEntry', [
+    'path', 'folder', 'filename', 'mtime', 'size',
+    'norm_artist', 'norm_title', 'norm_filename_track',
+])
+
+FolderSnapshot = namedtuple('FolderSnapshot', ['files', 'subdirs'])
+
+class DirectorySnapshotCache:
+    """
+    Caches one listing per folder for the duration of a sync cycle.
+    files maps the case-folded filename to its full path. Callers that write
+    into a folder (downloads, renames) must invalidate it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshots: Dict[str, FolderSnapshot] = {}
+
+    def get(self, folder: str) -> FolderSnapshot:
+        with self._lock:
+            snapshot = self._snapshots.get(folder)
+        if snapshot is not None:
+            return snapshot
+
+        files, subdirs = {}, []
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                    else:
+                        files[entry.name.casefold()] = entry.path
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        snapshot = FolderSnapshot(files, subdirs)
+        with self._lock:
+            self._snapshots[folder] = snapshot
+        return snapshot
+
+    def filenames(self, folder: str) -> set:
+        return {os.path.basename(path) for path in self.get(folder).files.values()}
+
+    def invalidate(self, folder: str):
+        with self._lock:
+            self._snapshots.pop(folder, None)
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+# Shared by the index and the downloader; cleared at the start of every sync cycle
+directory_snapshots = DirectorySnapshotCache()
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_library_index(music_path: str) -> 'LibraryIndex':
+    """
+    Returns the process-wide index stored under music_path, opening it on first use.
+    """
+    with _indexes_lock:
+        index = _indexes.get(music_path)
+        if index is None:
+            index = LibraryIndex(os.path.join(music_path, INDEX_FILENAME))
+            _indexes[music_path] = index
+        return index
+
+def is_audio_file(filename: str) -> bool:
+    return filename.lower().endswith(AUDIO_EXTENSIONS)
+
+def _format_priority(filename: str) -> int:
+    name_lower = filename.lower()
+    for priority, extension in enumerate(AUDIO_EXTENSIONS):
+        if name_lower.endswith(extension):
+            return priority
+    return len(AUDIO_EXTENSIONS)
+
+def _filename_track(filename: str) -> str:
+    """
+    Extracts the normalized track part from an "Artist - Track.ext" filename.
+    """
+    if ' - ' not in filename:
+        return ''
+    return normalize_for_matching(filename.split(' - ', 1)[1].rsplit('.', 1)[0])
+
+class LibraryIndex:
+    """
+    Index of local audio files, persisted in SQLite and mirrored in memory for lookups.
+    All public methods are safe to call from the download worker threads.
+    """
+    def __init__(self, db_path: str, snapshots: DirectorySnapshotCache = None):
+        self.db_path = db_path
+        self.snapshots = snapshots or directory_snapshots
+        # Set while a library watcher keeps the index current (see library_watcher)
+        self.watched = False
+        self._lock = threading.RLock()
+        self._entries: Dict[str, IndexEntry] = {}
+        self._folders: Dict[str, Dict[str, IndexEntry]] = {}
+
+        try:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️  Could not open library index at '{db_path}', using in-memory index: {e}")
+            self._db = sqlite3.connect(':memory:', check_same_thread=False)
+
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                folder TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL,
+                norm_artist TEXT NOT NULL,
+                norm_title TEXT NOT NULL,
+                norm_filename_track TEXT NOT NULL
+            )
+        ''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS files_folder ON files (folder)')
+        self._db.commit()
+
+        for row in self._db.execute('SELECT ' + ', '.join(IndexEntry._fields) + ' FROM files'):
+            self._add(IndexEntry(*row))
+        logging.info(f"💾 Loaded {len(self._entries)} files from library index.")
+
+    def _add(self, entry: IndexEntry):
+        self._entries[entry.path] = entry
+        self._folders.setdefault(entry.folder, {})[entry.path] = entry
+
+    def _discard(self, path: str):
+        entry = self._entries.pop(path, None)
+        if entry:
+            folder_entries = self._folders.get(entry.folder)
+            if folder_entries is not None:
+                folder_entries.pop(path, None)
+                if not folder_entries:
+                    del self._folders[entry.folder]
+
+    def _read_entry(self, path: str, stat: os.stat_result) -> IndexEntry:
+        folder, filename = os.path.split(path)
+        tag_artist = tag_title = None
+        try:
+            audiofile = mutagen.File(path, easy=True)
+            if audiofile:
+                tag_artist = audiofile.get('artist', [None])[0]
+                tag_title = audiofile.get('title', [None])[0]
+        except Exception as e:
+            logging.debug(f"Could not read metadata for '{filename}': {e}")
+        return IndexEntry(
+            path, folder, filename, stat.st_mtime, stat.st_size,
+            normalize_for_matching(tag_artist), normalize_for_matching(tag_title),
+            _filename_track(filename),
+        )
+
+    def _persist(self, upserts: List[IndexEntry], deletes: List[str]):
+        if not upserts and not deletes:
+            return
+        placeholders = ', '.join('?' * len(IndexEntry._fields))
+        with self._db:
+            self._db.executemany(f'INSERT OR REPLACE INTO files VALUES ({placeholders})', upserts)
+            self._db.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in deletes])
+
+    def _paths_under(self, root: str) -> List[str]:
+        prefix = os.path.join(root, '')
+        return [path for path in self._entries if path.startswith(prefix)]
+
+    def refresh(self, root: str, snapshots: DirectorySnapshotCache = None) -> int:
+        """
+        Incrementally syncs the index with the files below root.
+        Only new or modified files (by mtime/size) have their tags read.
+        snapshots overrides the per-cycle listing cache (e.g. a fresh one to see
+        changes made since the cycle started). Returns the number of changed entries.
+        """
+        snapshots = snapshots or self.snapshots
+        seen = set()
+        upserts = []
+        pending = [root]
+        while pending:
+            folder = pending.pop()
+            snapshot = snapshots.get(folder)
+            pending.extend(os.path.join(folder, d) for d in snapshot.subdirs if not d.startswith('.'))
+            for path in snapshot.files.values():
+                if not is_audio_file(path):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                seen.add(path)
+                entry = self._entries.get(path)
+                if entry and entry.mtime == stat.st_mtime and entry.size == stat.st_size:
+                    continue
+                upserts.append(self._read_entry(path, stat))
+
+        with self._lock:
+            deletes = [path for path in self._paths_under(root) if path not in seen]
+            for entry in upserts:
+                self._add(entry)
+            for path in deletes:
+                self._discard(path)
+            self._persist(upserts, deletes)
+
+        if upserts or deletes:
+            logging.info(f"💾 Library index refreshed for '{root}': {len(upserts)} updated, {len(deletes)} removed")
+        return len(upserts) + len(deletes)
+
+    def update(self, path: str):
+        """
+        Re-indexes a single file after it was written, or drops it if it no longer exists.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.remove(path)
+            return
+        entry = self._read_entry(path, stat)
+        with self._lock:
+            self._add(entry)
+            self._persist([entry], [])
+
+    def remove(self, path: str):
+        with self._lock:
+            if path in self._entries:
+                self._discard(path)
+                self._persist([], [path])
+
+    def rename(self, old_path: str, new_path: str):
+        with self._lock:
+            self._discard(old_path)
+            self._persist([], [old_path])
+        self.update(new_path)
+
+    def contains(self, path: str) -> bool:
+        return path in self._entries
+
+    def entries(self, folder: str) -> List[IndexEntry]:
+        """
+        Returns the indexed audio files of a folder, FLAC files first.
+        """
+        with self._lock:
+            folder_entries = list(self._folders.get(folder, {}).values())
+        return sorted(folder_entries, key=lambda entry: (_format_priority(entry.filename), entry.filename))
+
+    def find_by_title(self, folder: str, track_title: str) -> Optional[IndexEntry]:
+        """
+        Finds a file in folder whose filename or title tag matches track_title.
+        """
+        normalized_track = normalize_for_matching(track_title)
+        for entry in self.entries(folder):
+            if entry.norm_filename_track == normalized_track or (entry.norm_title and entry.norm_title == normalized_track):
+                return entry
+        return None
+
+    def find_by_tags(self, folder: str, artist_name: str, track_title: str) -> Optional[IndexEntry]:
+        """
+        Finds a file in folder whose artist and title tags both match.
+        """
+        normalized_artist = normalize_for_matching(artist_name)
+        normalized_track = normalize_for_matching(track_title)
+        for entry in self.entries(folder):
+            if entry.norm_artist and entry.norm_artist == normalized_artist and entry.norm_title == normalized_track:
+                return entry
+        return None
@@ -0,0 +1,243 @@
+"""
+library_watcher.py - Live library watcher for Plexify
+
+This module keeps the library index of MUSIC_PATH current between sync cycles,
+so the sync path can query the index instead of walking every playlist folder.
+On Linux it follows changes through inotify (bound with ctypes, no extra
+dependency): files that are added, renamed or deleted are re-indexed as soon as
+the kernel reports them. Where inotify is unavailable, or for network mounts
+whose remote changes inotify can't see, the library is polled instead.
+
+Enabled with WATCH_LIBRARY.
+
+Key classes/functions:
+- InotifyWatcher: Follows library changes through inotify
+- PollingWatcher: Re-scans the library at a fixed interval
+- start_library_watcher: Starts the shared watcher for a music path
+"""
+
+import os
+import abc
+import errno
+import ctypes
+import ctypes.util
+import logging
+import select
+import struct
+import threading
+from typing import Dict
+from library_index import LibraryIndex, DirectorySnapshotCache, get_library_index, directory_snapshots, is_audio_file
+
+# inotify event flags (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+_EVENT = struct.Struct('iIII')
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+def start_library_watcher(music_path: str, poll: bool = False, poll_interval: float = 60) -> 'LibraryWatcher':
+    """
+    Starts the process-wide watcher for music_path (once) and returns it.
+    Uses inotify unless poll is set or inotify is unavailable.
+    """
+    with _watchers_lock:
+        watcher = _watchers.get(music_path)
+        if watcher is None:
+            index = get_library_index(music_path)
+            if not poll:
+                try:
+                    watcher = InotifyWatcher(music_path, index)
+                except OSError as e:
+                    logging.warning(f"⚠️  inotify unavailable ({e}), polling the library every {poll_interval:g}s instead")
+            if watcher is None:
+                watcher = PollingWatcher(music_path, index, poll_interval)
+            watcher.start()
+            _watchers[music_path] = watcher
+        return watcher
+
+class LibraryWatcher(abc.ABC):
+    """
+    Background thread that keeps index current for everything below music_path.
+    The index is marked as watched once the initial scan is done.
+    """
+    def __init__(self, music_path: str, index: LibraryIndex):
+        self.music_path = music_path
+        self.index = index
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='library-watcher', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.index.watched = False
+
+    def rescan(self, root: str = None) -> int:
+        """
+        Re-indexes root (the whole library by default) from fresh folder listings.
+        """
+        root = root or self.music_path
+        changed = self.index.refresh(root, snapshots=DirectorySnapshotCache())
+        if changed:
+            # The sync cycle's cached listings may predate the changes
+            directory_snapshots.clear()
+        return changed
+
+    @abc.abstractmethod
+    def _run(self):
+        """
+        Thread body: indexes the library, sets index.watched and follows changes until stopped.
+        """
+
+class PollingWatcher(LibraryWatcher):
+    """
+    Re-scans the library every interval seconds. Only files whose mtime/size
+    changed have their tags read, so a poll mostly costs one stat per file.
+    """
+    def __init__(self, music_path: str, index: LibraryIndex, interval: float = 60):
+        super().__init__(music_path, index)
+        self.interval = max(1.0, interval)
+
+    def _run(self):
+        logging.info(f"👀 Polling '{self.music_path}' for library changes every {self.interval:g}s")
+        while True:
+            try:
+                self.rescan()
+                self.index.watched = True
+            except Exception as e:
+                logging.error(f"💥 Library poll failed: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+class InotifyWatcher(LibraryWatcher):
+    """
+    Follows changes below music_path with one inotify watch per folder.
+    Raises OSError if inotify isn't available.
+    """
+    def __init__(self, music_path: str, index: LibraryIndex):
+        super().__init__(music_path, index)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported on this platform')
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self._paths: Dict[int, str] = {}
+        try:
+            self._add_tree(music_path)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def _add_watch(self, folder: str):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, 'inotify watch limit reached (raise fs.inotify.max_user_watches)')
+            if error not in (errno.ENOENT, errno.ENOTDIR):
+                raise OSError(error, f"{os.strerror(error)}: '{folder}'")
+            return
+        self._paths[wd] = folder
+
+    def _add_tree(self, root: str):
+        pending = [root]
+        while pending:
+            folder = pending.pop()
+            # Watch before listing, so a subfolder created in between is still reported
+            self._add_watch(folder)
+            try:
+                with os.scandir(folder) as it:
+                    # Hidden folders (content store, ...) are not indexed either
+                    pending.extend(entry.path for entry in it if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.'))
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+    def _remove_tree(self, root: str):
+        prefix = os.path.join(root, '')
+        for wd, folder in list(self._paths.items()):
+            if folder == root or folder.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                self._paths.pop(wd, None)
+
+    def _run(self):
+        logging.info(f"👀 Watching '{self.music_path}' for library changes ({len(self._paths)} folders)")
+        try:
+            self.rescan()
+            self.index.watched = True
+            while not self._stop.is_set():
+                readable, _, _ = select.select([self._fd], [], [], 1.0)
+                if readable:
+                    self._read_events()
+        except Exception as e:
+            # Without events the index would silently go stale; let the sync cycles refresh it again
+            logging.error(f"💥 Library watcher stopped: {e}")
+            self.index.watched = False
+        finally:
+            os.close(self._fd)
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+            try:
+                self._handle(wd, mask, os.fsdecode(name))
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise
+                logging.warning(f"⚠️  Could not process library change for '{os.fsdecode(name)}': {e}")
+
+    def _handle(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            logging.warning("⚠️  Library watcher missed events, re-scanning the library")
+            self.rescan()
+            return
+        if mask & IN_IGNORED:
+            self._paths.pop(wd, None)
+            return
+        folder = self._paths.get(wd)
+        if folder is None or not name:
+            return
+
+        path = os.path.join(folder, name)
+        directory_snapshots.invalidate(folder)
+        if mask & IN_ISDIR:
+            if name.startswith('.'):
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path)
+                self.rescan(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._remove_tree(path)
+                self.rescan(path)
+        elif is_audio_file(name):
+            # Links from the content store only produce IN_CREATE; new downloads are re-read on IN_CLOSE_WRITE
+            if mask & (IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.index.update(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.index.remove(path)
@@ -6,15 +6,23 @@ No Plex playlist operations - use Plex Smart Playlists instead.
 """
 
 import os
+import asyncio
 import logging
 import time
 import spotipy
+from concurrent.futures import ThreadPoolExecutor
 from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
 from plexapi.server import PlexServer
 
-from utils import runSync, parseSpotifyURI
-from plex_utils import get_one_star_tracks, delete_plex_track, reset_stats, print_sync_recap
-from spotify_utils import removeTrackFromPlaylist
+from utils import runSync, parseSpotifyURI, save_cached_playlists
+from async_sync import runSyncAsync
+from plex_utils import get_one_star_tracks, delete_plex_track, reset_stats, print_sync_recap, plex_workers, get_low_rated_tracks_by_section
+from spotify_utils import removeTracksFromPlaylist, forgetPlaylistTracks, createSpotifyClient, getCachedPlaylistTracks, buildTrackMatchIndex, spotify_rate_limiter
+from common_utils import normalize_for_matching
+from content_store import get_content_store
+from config import get_runtime_config
+from library_watcher import start_library_watcher
+from sync_scheduler import SyncScheduler
 
 # Configure logging
 log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
@@ -67,8 +75,8 @@ def get_spotify_client():
         # Get a fresh access token using the refresh token
         try:
             token_info = auth_manager.refresh_access_token(refresh_token)
-            sp = spotipy.Spotify(auth=token_info['access_token'])
-            return sp, None
+            # All API calls share the process-wide Spotify rate limit
+            return createSpotifyClient(auth=token_info['access_token']), None
         except Exception as e:
             return None, f"Failed to refresh token: {e}"
     else:
@@ -77,11 +85,10 @@ def get_spotify_client():
         logging.warning("⚠️  Track removal from Spotify playlists will NOT work!")
         logging.warning("⚠️  Run generate_spotify_token.py to get a refresh token")
         
-        sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(
+        return createSpotifyClient(auth_manager=SpotifyClientCredentials(
             client_id=client_id,
             client_secret=client_secret
-        ))
-        return sp, None
+        )), None
 
 
 def create_resilient_spotify_client():
@@ -157,49 +164,109 @@ def main():
     logging.info("✅ Successfully connected to Plex.")
 
     parsed_uris = [parseSpotifyURI(uri.strip()) for uri in spotify_uris]
-    seconds_to_wait = int(os.environ.get('SECONDS_TO_WAIT', 3600))
+    # Each URI is checked on its own adaptive schedule, starting at SECONDS_TO_WAIT
+    scheduler = SyncScheduler(
+        parsed_uris,
+        base_interval=int(os.environ.get('SECONDS_TO_WAIT', 3600)),
+        min_interval=int(os.environ.get('SYNC_MIN_INTERVAL', 300)),
+        max_interval=int(os.environ.get('SYNC_MAX_INTERVAL', 21600)),
+        hourly_budget=int(os.environ.get('SPOTIFY_HOURLY_BUDGET', 1000)),
+    )
+    sync_mode = os.environ.get('SYNC_MODE', 'sync').lower()
+    # Per-track settings are resolved once here and passed down to every sync cycle
+    config = get_runtime_config()
+    logging.info(f"⚙️  Music path: {config.music_path}, preferred format: {config.audio_format.upper()}, ffmpeg: {config.ffmpeg_location or 'not found'}")
+
+    # Optionally keep the library index current between cycles instead of rescanning playlist folders
+    watch_library = os.environ.get('WATCH_LIBRARY', 'false').lower()
+    if config.music_path and watch_library in ['true', '1', 'yes', 'poll']:
+        start_library_watcher(config.music_path, poll=watch_library == 'poll',
+                              poll_interval=float(os.environ.get('WATCH_POLL_INTERVAL', '60')))
 
     while True:
+        due_uris = []
         try:
+            due_uris = scheduler.pop_due()
+            if not due_uris:
+                seconds_to_wait = scheduler.seconds_until_due()
+                logging.info(f"⏰ Waiting {seconds_to_wait:.0f} seconds before next sync...")
+                time.sleep(seconds_to_wait)
+                continue
+            calls_before = spotify_rate_limiter.acquired
+
             # Recreate Spotify client at the start of each sync cycle
             # This ensures we always have a fresh token, even after long sleeps
-            logging.info("🔄 Creating fresh Spotify client for this sync cycle...")
+            logging.info(f"🔄 Creating fresh Spotify client for this sync cycle ({len(due_uris)} of {len(parsed_uris)} URIs due)...")
             sp, error = create_resilient_spotify_client()
             if error:
                 logging.error(f"❌ Failed to create Spotify client: {error}")
-                logging.info("⏳ Waiting 60 seconds before retry...")
-                time.sleep(60)
+                scheduler.record_failure(due_uris)
                 continue
 
             # At the start of each sync cycle
             reset_stats()
 
-            # Sync playlists from Spotify
-            synced_playlists = runSync(sp, parsed_uris)
+            if sync_mode == 'async':
+                # Playlists sync concurrently; each one's 1-star deletions run once its downloads finish
+                # One library-wide 1-star query per cycle, shared by every playlist's Plex stage
+                low_rated_tracks = get_low_rated_tracks_by_section(plex)
+                # The Plex stage already runs PLEX_CONCURRENCY playlists at once, so each deletes serially
+                plex_stage = lambda playlist: process_one_star_deletions(plex, sp, [playlist], low_rated_tracks, delete_workers=1)
+                synced_playlists = asyncio.run(runSyncAsync(sp, due_uris, plex_stage=plex_stage, config=config))
+            else:
+                # Sync playlists from Spotify
+                synced_playlists = runSync(sp, due_uris, config=config)
+                
+                # Process 1-star deletions for each synced playlist
+                if process_one_star_deletions(plex, sp, synced_playlists):
+                    save_cached_playlists(synced_playlists)
             
-            # Process 1-star deletions for each synced playlist
-            process_one_star_deletions(plex, sp, synced_playlists)
+            # Free stored downloads that left every playlist
+            store = get_content_store(config.music_path) if config.music_path and synced_playlists else None
+            if store:
+                store.sweep(playlist_track_ids(synced_playlists))
             
             # At the end of each sync cycle (before sleeping)
             print_sync_recap()
-
-            logging.info(f"⏰ Waiting {seconds_to_wait} seconds before next sync...")
-            time.sleep(seconds_to_wait)
+            scheduler.record(due_uris, synced_playlists, spotify_rate_limiter.acquired - calls_before)
             
         except KeyboardInterrupt:
             logging.info("👋 Shutting down Plexify.") 
             break
         except Exception as e:
             logging.error(f"💥 Error in main loop: {e}")
-            time.sleep(60)
+            if due_uris:
+                scheduler.record_failure(due_uris)
+            else:
+                time.sleep(60)
 
-def process_one_star_deletions(plex: PlexServer, sp: spotipy.Spotify, playlists: list):
+def process_one_star_deletions(plex: PlexServer, sp: spotipy.Spotify, playlists: list, low_rated_tracks: dict = None,
+                               delete_workers: int = None) -> bool:
     """
     Check all Plex libraries for 1-star rated tracks and remove them from both Plex and Spotify.
+    
+    low_rated_tracks maps library titles to their 1-star tracks (see
+    get_low_rated_tracks_by_section); it is fetched with a single Plex query if not
+    given. Spotify track lists are only loaded (from the cache when complete) for
+    playlists that have 1-star tracks. Spotify removals are sent in batches per
+    playlist and the Plex deletes run concurrently (delete_workers at once,
+    PLEX_CONCURRENCY by default). Removed tracks are dropped from
+    the cached playlists; their new snapshot_id is only taken if the cached one was
+    still current, so unsynced Spotify edits are picked up by the next check.
+    Returns True if any cached playlist was updated and the cache should be saved.
     """
     logging.info("⭐ Checking for 1-star rated tracks across all playlists...")
     
+    if low_rated_tracks is None:
+        low_rated_tracks = get_low_rated_tracks_by_section(plex)
+    
+    # Most cycles have nothing to delete
+    if low_rated_tracks == {}:
+        logging.info("✅ No 1-star tracks to delete")
+        return False
+    
     total_deleted = 0
+    cache_changed = False
     
     for playlist in playlists:
         playlist_name = playlist.get('name', 'Unknown')
@@ -209,11 +276,12 @@ def process_one_star_deletions(plex: PlexServer, sp: spotipy.Spotify, playlists:
             logging.warning(f"⚠️ Skipping playlist '{playlist_name}' - no ID found")
             continue
         
-        # Fetch full Spotify playlist data
-        spotify_playlist = sp.playlist(playlist_id, fields="tracks.items(track(id,name,artists))")
-        
-        # Get 1-star tracks from Plex library (library name = playlist name)
-        one_star_tracks = get_one_star_tracks(plex, playlist_name)
+        # Get 1-star tracks from Plex library (library name = playlist name);
+        # only query the library itself if the library-wide query failed
+        if low_rated_tracks is None:
+            one_star_tracks = get_one_star_tracks(plex, playlist_name)
+        else:
+            one_star_tracks = low_rated_tracks.get(playlist_name, [])
         
         if not one_star_tracks:
             logging.debug(f"✨ No 1-star tracks found in playlist: {playlist_name}")
@@ -221,66 +289,74 @@ def process_one_star_deletions(plex: PlexServer, sp: spotipy.Spotify, playlists:
         
         logging.info(f"🔍 Found {len(one_star_tracks)} 1-star tracks in '{playlist_name}'")
         
+        # Only now load the Spotify tracks (cached if complete) and index them for O(1) lookups
+        track_index = buildTrackMatchIndex(getCachedPlaylistTracks(sp, playlist))
+        
+        # Find matching Spotify tracks in the playlist
+        matches = []
         for track_info in one_star_tracks:
-            plex_track = track_info['plex_track']
-            track_title = track_info['title']
-            track_artist = track_info['artist']
-            
-            # Find matching Spotify track in the playlist
-            spotify_track_id = find_spotify_track_in_playlist(sp, spotify_playlist, track_title, track_artist)
-            
-            if spotify_track_id:
-                # Remove from Spotify playlist
+            spotify_track_id = find_spotify_track_in_playlist(track_index, track_info['title'], track_info['artist'])
+            if not spotify_track_id:
+                logging.warning(f"❓ Could not find '{track_info['artist']} - {track_info['title']}' in Spotify playlist '{playlist_name}'")
+            matches.append((track_info, spotify_track_id))
+        
+        # Remove from Spotify playlist in batches
+        spotify_ids = [track_id for _, track_id in matches if track_id]
+        failed = {}
+        if spotify_ids:
+            removed, failed, snapshot_id = removeTracksFromPlaylist(sp, playlist_id, spotify_ids, playlist.get('snapshot_id'))
+            if removed:
+                forgetPlaylistTracks(playlist, removed, snapshot_id)
+                cache_changed = True
+                # Don't hand rejected tracks to other playlists from the content store
+                music_path = get_runtime_config().music_path
+                store = get_content_store(music_path) if music_path else None
+                if store:
+                    for track_id in removed:
+                        store.discard(track_id)
+        
+        to_delete = []
+        for track_info, spotify_track_id in matches:
+            # The track is deleted from Plex even if Spotify refused the removal (e.g. in read-only mode)
+            if spotify_track_id in failed:
+                logging.error(f"❌ Failed to remove '{track_info['artist']} - {track_info['title']}' from Spotify: {failed[spotify_track_id]}")
+            elif spotify_track_id:
+                logging.info(f"🗑️ Removed '{track_info['artist']} - {track_info['title']}' from Spotify playlist '{playlist_name}'")
+            to_delete.append(track_info['plex_track'])
+        
+        # Delete from Plex library and filesystem
+        with ThreadPoolExecutor(max_workers=delete_workers or plex_workers, thread_name_prefix='plex-delete') as executor:
+            for future in [executor.submit(delete_plex_track, plex_track, playlist_name) for plex_track in to_delete]:
                 try:
-                    removeTrackFromPlaylist(sp, playlist_id, spotify_track_id)
-                    logging.info(f"🗑️ Removed '{track_artist} - {track_title}' from Spotify playlist '{playlist_name}'")
+                    future.result()
+                    total_deleted += 1
                 except Exception as e:
-                    logging.error(f"❌ Failed to remove from Spotify: {e}")
-                    continue
-            else:
-                logging.warning(f"❓ Could not find '{track_artist} - {track_title}' in Spotify playlist '{playlist_name}'")
-            
-            # Delete from Plex library and filesystem
-            try:
-                delete_plex_track(plex_track, playlist_name)
-                total_deleted += 1
-            except Exception as e:
-                logging.error(f"❌ Failed to delete from Plex: {e}")
+                    logging.error(f"❌ Failed to delete from Plex: {e}")
     
     if total_deleted > 0:
         logging.info(f"🎉 Completed 1-star cleanup: {total_deleted} tracks deleted")
     else:
         logging.info("✅ No 1-star tracks to delete")
+    return cache_changed
+
+def playlist_track_ids(playlists: list) -> set:
+    """
+    Returns the Spotify track IDs the playlists contain or have local files for.
+    """
+    track_ids = set()
+    for playlist in playlists:
+        items = (playlist.get('tracks') or {}).get('items') or []
+        track_ids.update((item.get('track') or {}).get('id') for item in items)
+        track_ids.update(playlist.get('local_tracks') or {})
+    track_ids.discard(None)
+    return track_ids
 
-def find_spotify_track_in_playlist(sp: spotipy.Spotify, playlist: dict, track_title: str, track_artist: str) -> str:
+def find_spotify_track_in_playlist(track_index: dict, track_title: str, track_artist: str) -> str:
     """
     Find a Spotify track ID in a playlist by matching title and artist.
-    Returns the track ID if found, None otherwise.
+    track_index comes from buildTrackMatchIndex. Returns the track ID if found, None otherwise.
     """
-    tracks = playlist.get('tracks', {}).get('items', [])
-    
-    # Normalize strings for comparison
-    normalized_title = track_title.lower().strip()
-    normalized_artist = track_artist.lower().strip()
-    
-    for item in tracks:
-        track = item.get('track')
-        if not track:
-            continue
-        
-        spotify_title = track.get('name', '').lower().strip()
-        spotify_artists = track.get('artists', [])
-        
-        # Check if title matches
-        if normalized_title != spotify_title:
-            continue
-        
-        # Check if any artist matches
-        for artist in spotify_artists:
-            if normalized_artist == artist.get('name', '').lower().strip():
-                return track.get('id')
-    
-    return None
+    return track_index.get((normalize_for_matching(track_title), normalize_for_matching(track_artist)))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,7 +1,15 @@
-from typing import List, Dict
-from common_utils import createFolder
-from spotify_utils import getSpotifyTracks
+from typing import Iterable, Iterator, List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from common_utils import createFolder, HostRateLimiter, normalize_for_matching, retry_policy
+from library_index import get_library_index, LibraryIndex, directory_snapshots
+from search_cache import get_search_cache
+from content_store import get_content_store, ContentStore
+from config import RuntimeConfig, get_runtime_config
+from ytdlp_engine import get_ytdlp_engine
+from spotify_utils import iterSpotifyTracks, diffPlaylistTracks, compactTrackItem
 from plexapi.server import PlexServer
+from plexapi.utils import joinArgs
 from youtubesearchpython import VideosSearch
 
 import warnings
@@ -10,74 +18,164 @@ warnings.filterwarnings('ignore', module='eyed3.id3.frames')
 import logging
 import os
 import subprocess
-import time
-import mutagen
+import threading
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 
 # Supported audio formats to check for existing files (FLAC first, then MP3)
 SUPPORTED_FORMATS = ['.flac', '.mp3']
 
-# In-memory cache for YouTube search results to avoid rate-limiting during a single run
-youtube_url_cache = {}
 spotify_client_id = os.environ.get('SPOTIPY_CLIENT_ID')
 spotify_client_secret = os.environ.get('SPOTIPY_CLIENT_SECRET')
 
-class SpotifyThrottled:
-    """
-    A wrapper for the spotipy.Spotify client that throttles API calls.
-    """
-    def __init__(self, spotify_client):
-        self._spotify = spotify_client
-        # Default to 0.1s (10 req/s), adjustable via env var
-        self.throttle_delay = float(os.environ.get('DOWNLOAD_DELAY', '0.1'))
-        self.last_call_time = 0
+# Search/download worker pool sizes and per-host spacing between search/download requests
+YOUTUBE_HOST = 'www.youtube.com'
+download_workers = max(1, int(os.environ.get('DOWNLOAD_WORKERS', '4')))
+search_workers = max(1, int(os.environ.get('SEARCH_WORKERS', '4')))
+download_limiter = HostRateLimiter(float(os.environ.get('DOWNLOAD_DELAY', '0.1')))
 
-    def __getattr__(self, name):
-        attr = getattr(self._spotify, name)
-        if callable(attr):
-            def throttled_method(*args, **kwargs):
-                current_time = time.time()
-                time_since_last_call = current_time - self.last_call_time
-                
-                if time_since_last_call < self.throttle_delay:
-                    sleep_time = self.throttle_delay - time_since_last_call
-                    logging.debug(f"Throttling Spotify API call for {sleep_time:.2f}s")
-                    time.sleep(sleep_time)
-                
-                result = attr(*args, **kwargs)
-                self.last_call_time = time.time()
-                return result
-            return throttled_method
-        return attr
+# Plex requests (e.g. track deletions) running at once
+plex_workers = max(1, int(os.environ.get('PLEX_CONCURRENCY', '2')))
+
+# Items per request when paging Plex search results
+PLEX_PAGE_SIZE = max(1, int(os.environ.get('PLEX_PAGE_SIZE', '200')))
+
+# Server-side filter for 1-star tracks (userRating is on a 0-10 scale, so 1 star is 2.0)
+LOW_RATING_FILTERS = {'userRating>>': 0, 'userRating<<': 3}
+PLEX_TRACK_TYPE = 10
 
-def ensureLocalFiles(sp, playlist: dict):
+# downloadSpotifyTrack detects new files by diffing the folder listing, so downloads
+# into the same album folder must not overlap (even across playlists syncing at once)
+_folder_locks = {}
+_folder_locks_guard = threading.Lock()
+
+def _get_folder_lock(folder: str) -> threading.Lock:
+    with _folder_locks_guard:
+        return _folder_locks.setdefault(folder, threading.Lock())
+
+def ensureLocalFiles(sp, playlist: dict, config: RuntimeConfig = None) -> Dict[str, str]:
     """
     Ensures that all tracks in a Spotify playlist are downloaded locally.
     
+    Only tracks added since the last sync (compared against playlist['local_tracks'],
+    the track ID -> file path map stored in the cache) go through the filesystem
+    existence check and the download queue. The updated map is stored back on the
+    playlist and returned.
+    
+    Tracks are streamed page -> existence check -> download pipeline, so downloads
+    start as soon as the first missing track is found and only one page of API
+    results is held at a time.
+    
+    config defaults to the process-wide RuntimeConfig.
+    
     File structure: MUSIC_PATH/<Playlist>/<Artist>/<Album>/<Artist - Track>.mp3
     """
-    musicPath = os.environ.get('MUSIC_PATH')
+    config = config or get_runtime_config()
+    musicPath = config.music_path
     if not musicPath:
         logging.error("❌ MUSIC_PATH environment variable not set.")
-        return
+        return playlist.get('local_tracks') or {}
     
     playlistName = playlist.get('name', 'Unknown Playlist')
     logging.info(f"📁 Ensuring local files for playlist: {playlistName}")
     
-    # Wrap the Spotify client to throttle API calls
-    throttled_sp = SpotifyThrottled(sp)
-    tracks = getSpotifyTracks(throttled_sp, playlist)
+    index = openPlaylistIndex(musicPath, playlist)
+    local_tracks = {}
+    
+    # Per-host rate limiting is handled inside downloadSpotifyTrack via download_limiter
+    with DownloadPipeline(index, get_content_store(musicPath), config=config) as pipeline:
+        for track_id, job in iterMissingTracks(musicPath, playlist, iterPlaylistTracks(sp, playlist), index, local_tracks, config):
+            pipeline.submit(track_id, job)
+    
+    if pipeline.queued:
+        local_tracks.update(pipeline.downloaded)
+        logging.info(f"✅ Completed downloading {pipeline.queued} tracks")
+    else:
+        logging.info(f"✨ All tracks already present for playlist: {playlistName}")
+    
+    playlist['local_tracks'] = local_tracks
+    return local_tracks
+
+def iterPlaylistTracks(sp, playlist: dict) -> Iterator[Dict]:
+    """
+    Spotify stage: streams the compact tracks of a playlist page by page.
+    Once exhausted, the complete compact track list is stored on the playlist so an
+    unchanged playlist needs no paging next cycle.
+    """
+    tracks = []
+    for item in iterSpotifyTracks(sp, playlist):
+        compact = compactTrackItem(item)
+        tracks.append(compact)
+        yield compact
+    playlist['tracks'] = {'items': tracks, 'next': None, 'total': len(tracks)}
+
+def fetchPlaylistTracks(sp, playlist: dict) -> List[Dict]:
+    """
+    Spotify stage: pages through all tracks of a playlist and returns the compact items.
+    """
+    return list(iterPlaylistTracks(sp, playlist))
+
+def openPlaylistIndex(musicPath: str, playlist: dict) -> LibraryIndex:
+    """
+    Returns the library index with the playlist's folder brought up to date;
+    only changed files get their tags re-read. While a library watcher keeps the
+    index current, the folder isn't walked at all.
+    """
+    index = get_library_index(musicPath)
+    if not index.watched:
+        index.refresh(os.path.join(musicPath, sanitizeFilename(playlist.get('name', 'Unknown Playlist'))))
+    return index
+
+def planLocalFiles(musicPath: str, playlist: dict, tracks: List[Dict], config: RuntimeConfig = None) -> tuple:
+    """
+    Filesystem stage for a fully fetched track list.
     
-    download_queue = []
+    Returns (index, local_tracks, download_queue) where local_tracks maps track IDs to
+    files found on disk and download_queue holds (track_id, job) pairs for the missing
+    tracks, with job = (track_uri, output_folder, track_name, artist_name, expected_filepath).
+    """
+    index = openPlaylistIndex(musicPath, playlist)
+    local_tracks = {}
+    download_queue = list(iterMissingTracks(musicPath, playlist, tracks, index, local_tracks, config))
+    return index, local_tracks, download_queue
+
+def iterMissingTracks(musicPath: str, playlist: dict, tracks: Iterable[Dict], index: LibraryIndex, local_tracks: Dict[str, str],
+                      config: RuntimeConfig = None) -> Iterator[tuple]:
+    """
+    Filesystem stage: checks tracks as they arrive and yields (track_id, job) for each
+    one that is missing locally. Tracks found on disk are recorded in local_tracks.
     
+    Tracks already known from the last sync (playlist['local_tracks']) whose file is
+    still indexed, exists and lies in the current playlist folder are not checked
+    again; after a playlist rename they go through the normal check for the new folder. Lookups go through the library index, so no
+    folders are created here; the download stage creates them for queued tracks.
+    """
+    playlistName = playlist.get('name', 'Unknown Playlist')
     safePlaylistName = sanitizeFilename(playlistName)
     playlistFolder = os.path.join(musicPath, safePlaylistName)
+    playlistPrefix = os.path.join(playlistFolder, '')
+    file_extension = (config or get_runtime_config()).audio_format
+    
+    known_tracks = playlist.get('local_tracks') or {}
+    fresh_ids = set()
+    store = get_content_store(musicPath)
     
     for item in tracks:
         track = item.get('track')
         if not track:
             continue
+        
+        track_id = track.get('id')
+        if track_id in fresh_ids:
+            continue
+        if track_id:
+            fresh_ids.add(track_id)
+        # Delta against the tracks known to be present after the previous sync
+        known_path = known_tracks.get(track_id)
+        if (known_path and known_path.startswith(playlistPrefix)
+                and index.contains(known_path) and os.path.exists(known_path)):
+            local_tracks[track_id] = known_path
+            continue
             
         trackName = track.get('name', 'Unknown Track')
         artistName = track['artists'][0]['name'] if track.get('artists') else 'Unknown Artist'
@@ -90,46 +188,178 @@ def ensureLocalFiles(sp, playlist: dict):
         
         artistFolder = os.path.join(playlistFolder, safeArtist)
         albumFolder = os.path.join(artistFolder, safeAlbum)
-        createFolder(albumFolder)
         
-        # Define the standard filename - check for FLAC preference
-        prefer_flac = os.environ.get('PREFER_FLAC', 'true').lower() in ['true', '1', 'yes']
-        file_extension = 'flac' if prefer_flac else 'mp3'
+        # Define the standard filename in the preferred format
         expected_filename = f"{safeArtist} - {safeTrack}.{file_extension}"
         expected_filepath = os.path.join(albumFolder, expected_filename)
         
         logging.info(f"🔎 Checking for track '{safeTrack}' in path: '{albumFolder}'")
         
-        # Check if a file for this track already exists, even with a different name
-        if track_exists_in_directory(albumFolder, safeTrack):
-            continue
-            
-        # If not found by name, check by ID3 tags and rename if a match is found
-        if find_and_rename_track_by_tag(albumFolder, artistName, trackName, expected_filepath):
+        # Check if a file for this track already exists, even with a different name,
+        # then by ID3 tags (renaming the file if a match is found). Downloads may already
+        # be running, so don't rename while one is diffing this folder.
+        with _get_folder_lock(albumFolder):
+            existing_path = (track_exists_in_directory(index, albumFolder, safeTrack)
+                             or find_and_rename_track_by_tag(index, albumFolder, artistName, trackName, expected_filepath))
+        # Downloaded before for another playlist? Link it in instead of downloading it again
+        existing_path = existing_path or _materialize_from_store(store, index, track_id, albumFolder, expected_filepath)
+        if existing_path:
+            if track_id:
+                local_tracks[track_id] = existing_path
             continue
         
         logging.warning(f"❗ Track not found locally. Queuing for download to '{expected_filepath}'")
         
-        download_queue.append((track_uri, albumFolder, trackName, artistName, expected_filepath))
+        yield track_id, (track_uri, albumFolder, trackName, artistName, expected_filepath)
     
-    if download_queue:
-        logging.info(f"⬇️  Downloading {len(download_queue)} missing tracks...")
-        
-        for idx, (track_uri, output_folder, track_name, artist_name, expected_filepath) in enumerate(download_queue, 1):
-            downloadSpotifyTrack(track_uri, output_folder, track_name, artist_name, expected_filepath)
-            
-            # Rate limiting: wait 0.1s between downloads (10 requests/sec)
-            if idx < len(download_queue):
-                time.sleep(0.1)
-                
-        logging.info(f"✅ Completed downloading {len(download_queue)} tracks")
-    else:
-        logging.info(f"✨ All tracks already present for playlist: {playlistName}")
+    added, removed, unchanged = diffPlaylistTracks(known_tracks.keys(), fresh_ids)
+    logging.info(f"🧮 '{playlistName}': {len(added)} added, {len(removed)} removed, {len(unchanged)} unchanged tracks since last sync")
+    if removed:
+        logging.info(f"➖ {len(removed)} tracks were removed from '{playlistName}' on Spotify (local files are kept)")
+
+class DownloadPipeline:
+    """
+    Consumer side of the streaming sync: each submitted job is searched right away
+    (at most SEARCH_WORKERS at once) and then handed to the download pool (at most
+    DOWNLOAD_WORKERS at once). Jobs of one album folder are drained by a single
+    worker, reusing that thread's yt-dlp instance, like the batched download phase.
+    
+    Leaving the with-block waits for all jobs; downloaded then maps track IDs to
+    the new files.
+    """
+    def __init__(self, index: LibraryIndex, store: ContentStore = None, searchers: int = None, downloaders: int = None,
+                 config: RuntimeConfig = None):
+        self.index = index
+        self.store = store
+        self.config = config
+        self.queued = 0
+        self.downloaded: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._pending: Dict[str, List[tuple]] = {}
+        self._searches = ThreadPoolExecutor(max_workers=searchers or search_workers, thread_name_prefix='search')
+        self._downloads = ThreadPoolExecutor(max_workers=downloaders or download_workers, thread_name_prefix='download')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, track_id: str, job: tuple):
+        if self.queued == 0:
+            logging.info("⬇️  Missing tracks found, starting downloads...")
+        self.queued += 1
+        future = self._searches.submit(search_queued_track, job)
+        future.add_done_callback(lambda f: self._enqueue(track_id, job, f.result()))
+
+    def _enqueue(self, track_id: str, job: tuple, youtube_url: Optional[str]):
+        folder = job[1]
+        with self._lock:
+            start_worker = folder not in self._pending
+            self._pending.setdefault(folder, []).append((track_id, job, youtube_url))
+        if start_worker:
+            self._downloads.submit(self._drain, folder)
+
+    def _drain(self, folder: str):
+        while True:
+            with self._lock:
+                batch = self._pending[folder]
+                if not batch:
+                    del self._pending[folder]
+                    return
+                self._pending[folder] = []
+            try:
+                results = _download_batch(self.index, batch, self.store, self.config)
+            except Exception as e:
+                logging.error(f"💥 Download batch crashed for '{folder}': {e}")
+                continue
+            with self._lock:
+                for track_id, downloaded_path in results:
+                    if downloaded_path and track_id:
+                        self.downloaded[track_id] = downloaded_path
+
+    def close(self):
+        # Every search callback has queued its job once the search pool is shut down
+        self._searches.shutdown(wait=True)
+        self._downloads.shutdown(wait=True)
+
+def groupDownloadBatches(download_queue: List[tuple], youtube_urls: List[Optional[str]]) -> List[List[tuple]]:
+    """
+    Groups queued downloads and their resolved URLs into one batch per album folder.
+    Each batch is a list of (track_id, job, youtube_url) and is drained by a single worker.
+    """
+    batches = {}
+    for (track_id, job), youtube_url in zip(download_queue, youtube_urls):
+        batches.setdefault(job[1], []).append((track_id, job, youtube_url))
+    return list(batches.values())
+
+def search_queued_track(job: tuple) -> Optional[str]:
+    """
+    Search stage for a single queued download job. Never raises.
+    """
+    track_uri, _, track_name, artist_name, _ = job
+    track_id = track_uri.rsplit(':', 1)[-1] if track_uri else None
+    try:
+        return search_youtube_for_track(artist_name, track_name, track_id)
+    except Exception as e:
+        logging.error(f"💥 YouTube search crashed for '{artist_name} - {track_name}': {e}")
+        return None
+
+def _materialize_from_store(store: Optional[ContentStore], index: LibraryIndex, track_id: str, output_folder: str, expected_filepath: str) -> Optional[str]:
+    """
+    Links a track already in the content store into output_folder and indexes it.
+    Returns the new path, or None if the store doesn't have the track.
+    """
+    if not store or not store.lookup(track_id):
+        return None
+    with _get_folder_lock(output_folder):
+        path = store.materialize(track_id, expected_filepath)
+        if path:
+            directory_snapshots.invalidate(output_folder)
+            index.update(path)
+    return path
 
-def search_youtube_for_track(artist_name: str, track_name: str) -> str:
+def _download_batch(index: LibraryIndex, batch: List[tuple], store: ContentStore = None, config: RuntimeConfig = None) -> List[tuple]:
+    """
+    Downloads all queued tracks of one album folder on a single worker thread, reusing
+    that thread's yt-dlp instance, and records new files in the library index and the
+    content store. Tracks another playlist stored in the meantime are linked instead.
+    The album folder is only created once a track actually has to be downloaded.
+    Returns (track_id, downloaded_path) pairs, with a falsy path for failed items.
+    """
+    output_folder = batch[0][1][1]
+    results = []
+    for track_id, job, youtube_url in batch:
+        track_uri, _, track_name, artist_name, expected_filepath = job
+        stored_path = _materialize_from_store(store, index, track_id, output_folder, expected_filepath)
+        if stored_path:
+            results.append((track_id, stored_path))
+            continue
+        # Locked per track so existence checks streaming in for this folder can interleave
+        with _get_folder_lock(output_folder):
+            createFolder(output_folder)
+            try:
+                downloaded_path = downloadSpotifyTrack(track_uri, output_folder, track_name, artist_name, expected_filepath, youtube_url, config)
+            except Exception as e:
+                logging.error(f"💥 Download worker crashed for '{artist_name} - {track_name}': {e}")
+                track_download_failure()
+                downloaded_path = None
+            if downloaded_path:
+                index.refresh(output_folder)
+            else:
+                # Failed attempts can still leave files behind
+                directory_snapshots.invalidate(output_folder)
+        if downloaded_path and store:
+            store.add(track_id, downloaded_path)
+        results.append((track_id, downloaded_path))
+    return results
+
+def search_youtube_for_track(artist_name: str, track_name: str, track_id: str = None) -> str:
     """
     Searches YouTube for a track and returns the URL of the most likely official audio.
-    Uses an in-memory cache to avoid re-querying for the same track.
+    Uses a persistent cache keyed by Spotify track ID and query to avoid re-querying
+    for the same track; searches that found nothing are cached for a shorter time,
+    and transient errors are not cached at all.
     Returns None if no suitable video is found.
     """
     # Validate inputs first
@@ -143,8 +373,9 @@ def search_youtube_for_track(artist_name: str, track_name: str) -> str:
     search_query = f"{safe_artist} - {safe_track}"
     
     # Check cache first
-    if search_query in youtube_url_cache:
-        cached_result = youtube_url_cache[search_query]
+    youtube_url_cache = get_search_cache(get_runtime_config().music_path)
+    cache_hit, cached_result = youtube_url_cache.get(track_id, search_query)
+    if cache_hit:
         if cached_result:
             logging.info(f"📦 Found YouTube URL in cache for: '{search_query}'")
             return cached_result
@@ -155,25 +386,17 @@ def search_youtube_for_track(artist_name: str, track_name: str) -> str:
     logging.info(f"▶️  Searching YouTube for: '{search_query}'")
     
     try:
-        # Use yt-dlp to search but get video IDs instead of direct URLs
-        search_cmd = [
-            'yt-dlp',
-            '--get-id',  # Get video IDs instead of URLs
-            '--no-playlist',
-            f'ytsearch5:{search_query}'
-        ]
+        download_limiter.wait(YOUTUBE_HOST)
         
-        search_process = subprocess.run(search_cmd, capture_output=True, text=True, timeout=30)
+        # Use the in-process yt-dlp engine to search and get video IDs instead of direct URLs
+        video_ids = get_ytdlp_engine().search(search_query, count=5)
         
-        if search_process.returncode == 0 and search_process.stdout.strip():
-            video_ids = search_process.stdout.strip().split('\n')
-            if video_ids and video_ids[0]:
-                # Construct proper YouTube URL from video ID
-                first_video_id = video_ids[0]
-                youtube_url = f"https://www.youtube.com/watch?v={first_video_id}"
-                logging.info(f"🎯 Found YouTube URL via yt-dlp search: {youtube_url}")
-                youtube_url_cache[search_query] = youtube_url
-                return youtube_url
+        if video_ids:
+            # Construct proper YouTube URL from video ID
+            youtube_url = f"https://www.youtube.com/watch?v={video_ids[0]}"
+            logging.info(f"🎯 Found YouTube URL via yt-dlp search: {youtube_url}")
+            youtube_url_cache.put(track_id, search_query, youtube_url)
+            return youtube_url
         
         # If yt-dlp search fails, try the original method with better error handling
         logging.info(f"🔄 yt-dlp search failed, trying YoutubeSearchPython...")
@@ -183,14 +406,14 @@ def search_youtube_for_track(artist_name: str, track_name: str) -> str:
         search_result = videos_search.result()
         if not search_result or not isinstance(search_result, dict):
             logging.warning(f"❓ Invalid search result structure for '{search_query}'")
-            youtube_url_cache[search_query] = None
+            youtube_url_cache.put(track_id, search_query, None)
             return None
             
         results = search_result.get('result', [])
         
         if not results:
             logging.warning(f"❓ No YouTube results found for '{search_query}'")
-            youtube_url_cache[search_query] = None
+            youtube_url_cache.put(track_id, search_query, None)
             return None
             
         # Just take the first valid result to avoid complexity
@@ -198,321 +421,128 @@ def search_youtube_for_track(artist_name: str, track_name: str) -> str:
             if video and isinstance(video, dict) and video.get('link'):
                 video_url = video['link']
                 logging.info(f"⚠️  Using first available result: {video_url}")
-                youtube_url_cache[search_query] = video_url
+                youtube_url_cache.put(track_id, search_query, video_url)
                 return video_url
         
         logging.warning(f"❓ No valid YouTube results found for '{search_query}'")
-        youtube_url_cache[search_query] = None
+        youtube_url_cache.put(track_id, search_query, None)
         return None
         
-    except subprocess.TimeoutExpired:
-        logging.error(f"⏰ YouTube search timeout for '{search_query}'")
-        youtube_url_cache[search_query] = None
-        return None
     except TypeError as e:
         logging.error(f"💥 Type error in YouTube library for '{search_query}': {e}")
         logging.error(f"🔍 This is a known issue with YoutubeSearchPython library")
-        youtube_url_cache[search_query] = None
         return None
     except Exception as e:
         logging.error(f"💥 General error searching YouTube for '{search_query}': {e}")
-        youtube_url_cache[search_query] = None
         return None
 
-def normalize_for_matching(text: str) -> str:
-    """
-    Normalize text for fuzzy matching by removing special characters and converting to lowercase.
-    Handles cases like "AC/DC" -> "acdc", "Ac-Dc" -> "acdc", etc.
-    """
-    if not text:
-        return ""
-    
-    # Convert to lowercase and remove common separators and punctuation
-    normalized = text.lower()
-    # Remove these characters: / \ - _ . : ; , ( ) [ ] ' "
-    chars_to_remove = '/\\-_.,:;()[]\'\"'
-    for char in chars_to_remove:
-        normalized = normalized.replace(char, '')
-    
-    # Remove extra spaces
-    normalized = ' '.join(normalized.split())
-    
-    return normalized
-
-def track_exists_in_directory(folder: str, track_title: str) -> bool:
+def track_exists_in_directory(index: LibraryIndex, folder: str, track_title: str) -> Optional[str]:
     """
     Checks if FLAC first, then MP3 exists for the track.
-    Uses both filename and metadata matching for better accuracy.
+    Uses both filename and metadata matching (from the library index) for better accuracy.
+    Returns the path of the existing file, or None.
     """
-    try:
-        normalized_track = normalize_for_matching(track_title)
-        
-        # Check for FLAC first
-        for filename in os.listdir(folder):
-            name_lower = filename.lower()
-            if name_lower.endswith('.flac'):
-                # Check filename match (extract track name from "Artist - Track.flac")
-                if ' - ' in filename:
-                    filename_track = filename.split(' - ', 1)[1].rsplit('.', 1)[0]
-                    if normalize_for_matching(filename_track) == normalized_track:
-                        logging.debug(f"✅ Found existing FLAC by filename: '{filename}'")
-                        return True
-                
-                # Also check metadata if filename match fails
-                try:
-                    filepath = os.path.join(folder, filename)
-                    audiofile = mutagen.File(filepath, easy=True)
-                    if audiofile:
-                        tag_title = audiofile.get('title', [None])[0]
-                        if tag_title and normalize_for_matching(tag_title) == normalized_track:
-                            logging.debug(f"✅ Found existing FLAC by metadata: '{filename}'")
-                            return True
-                except:
-                    pass  # Skip files with bad metadata
-        
-        # Then check for MP3
-        for filename in os.listdir(folder):
-            name_lower = filename.lower()
-            if name_lower.endswith('.mp3'):
-                # Check filename match
-                if ' - ' in filename:
-                    filename_track = filename.split(' - ', 1)[1].rsplit('.', 1)[0]
-                    if normalize_for_matching(filename_track) == normalized_track:
-                        logging.debug(f"✅ Found existing MP3 by filename: '{filename}'")
-                        return True
-                
-                # Also check metadata if filename match fails
-                try:
-                    filepath = os.path.join(folder, filename)
-                    audiofile = mutagen.File(filepath, easy=True)
-                    if audiofile:
-                        tag_title = audiofile.get('title', [None])[0]
-                        if tag_title and normalize_for_matching(tag_title) == normalized_track:
-                            logging.debug(f"✅ Found existing MP3 by metadata: '{filename}'")
-                            return True
-                except:
-                    pass  # Skip files with bad metadata
-                
-    except FileNotFoundError:
-        return False
-    return False
+    entry = index.find_by_title(folder, track_title)
+    if entry:
+        logging.debug(f"✅ Found existing track: '{entry.filename}'")
+        return entry.path
+    return None
 
-def find_and_rename_track_by_tag(folder: str, artist_name: str, track_title: str, expected_filepath: str) -> bool:
+def find_and_rename_track_by_tag(index: LibraryIndex, folder: str, artist_name: str, track_title: str, expected_filepath: str) -> Optional[str]:
     """
-    Scans audio files in a directory, checks their metadata for a match,
+    Looks up audio files in a directory by their indexed metadata
     and renames the file if a match is found. Only supports FLAC and MP3.
     Uses normalized matching to handle artist name variations.
+    Returns the (possibly renamed) path of the matching file, or None.
     """
-    try:
-        normalized_artist = normalize_for_matching(artist_name)
-        normalized_track = normalize_for_matching(track_title)
-        
-        for filename in os.listdir(folder):
-            # Only check FLAC and MP3 files
-            if not (filename.lower().endswith('.flac') or filename.lower().endswith('.mp3')):
-                continue
-
-            current_filepath = os.path.join(folder, filename)
-            
-            try:
-                audiofile = mutagen.File(current_filepath, easy=True)
-                if not audiofile:
-                    continue
-            except Exception as e:
-                logging.warning(f"⚠️  Could not read metadata for '{filename}': {e}")
-                continue
-
-            tag_artist = audiofile.get('artist', [None])[0]
-            tag_title = audiofile.get('title', [None])[0]
-
-            if tag_artist and tag_title:
-                # Use normalized matching for both artist and title
-                if (normalize_for_matching(tag_artist) == normalized_artist and 
-                    normalize_for_matching(tag_title) == normalized_track):
-                    
-                    logging.info(f"✅ Found track by metadata tag: '{filename}' (Artist: '{tag_artist}' -> '{artist_name}', Title: '{tag_title}' -> '{track_title}')")
-                    
-                    if current_filepath != expected_filepath:
-                        logging.warning(f"🎨 Renaming '{filename}' to '{os.path.basename(expected_filepath)}'")
-                        os.rename(current_filepath, expected_filepath)
-                    
-                    return True
-    except FileNotFoundError:
-        return False
-    except Exception as e:
-        logging.error(f"❌ Error processing metadata in '{folder}': {e}")
+    entry = index.find_by_tags(folder, artist_name, track_title)
+    if not entry:
+        return None
+    
+    logging.info(f"✅ Found track by metadata tag: '{entry.filename}' (Artist: '{artist_name}', Title: '{track_title}')")
     
-    return False
+    if entry.path != expected_filepath:
+        logging.warning(f"🎨 Renaming '{entry.filename}' to '{os.path.basename(expected_filepath)}'")
+        try:
+            os.rename(entry.path, expected_filepath)
+        except OSError as e:
+            logging.error(f"❌ Error renaming '{entry.filename}' in '{folder}': {e}")
+            return entry.path
+        directory_snapshots.invalidate(folder)
+        index.rename(entry.path, expected_filepath)
+        return expected_filepath
+    
+    return entry.path
 
-def downloadSpotifyTrack(track_uri: str, output_folder: str, track_name: str, artist_name: str, expected_filepath: str):
+def _list_after_write(folder: str) -> set:
+    """
+    Drops the cached snapshot of a folder that was just written to and lists it again.
+    """
+    directory_snapshots.invalidate(folder)
+    return directory_snapshots.filenames(folder)
+
+def downloadSpotifyTrack(track_uri: str, output_folder: str, track_name: str, artist_name: str, expected_filepath: str,
+                         youtube_url: str = None, config: RuntimeConfig = None):
     """
     Downloads a single track using YouTube search + yt-dlp.
-    Format determined by PREFER_FLAC environment variable (default: true).
+    Format determined by config.prefer_flac (PREFER_FLAC, default: true).
+    youtube_url can be passed in when it was already resolved by a batched search phase.
+    Returns the path of the downloaded file, or False if every method failed.
     """
-    download_stats['downloads_attempted'] += 1
-    spotdl_log_level = os.environ.get('SPOTDL_LOG_LEVEL', os.environ.get('LOG_LEVEL', 'INFO')).upper()
-    prefer_flac = os.environ.get('PREFER_FLAC', 'true').lower() in ['true', '1', 'yes']
+    track_download_attempt()
+    config = config or get_runtime_config()
+    prefer_flac = config.prefer_flac
     formats_tried = []
     
-    # Get list of files before download
-    files_before = set()
-    if os.path.exists(output_folder):
-        files_before = set(os.listdir(output_folder))
+    # Get list of files before download (served from this cycle's folder snapshot)
+    files_before = directory_snapshots.filenames(output_folder)
     
     # Try YouTube search approach
-    logging.info(f"🔄 Using YouTube search for '{artist_name} - {track_name}'")
+    logging.info(f"🔄 Using YouTube for '{artist_name} - {track_name}'")
     
-    youtube_url = search_youtube_for_track(artist_name, track_name)
+    if not youtube_url:
+        track_id = track_uri.rsplit(':', 1)[-1] if track_uri else None
+        youtube_url = search_youtube_for_track(artist_name, track_name, track_id)
     if youtube_url:
-        try:
-            output_filename = f"{sanitizeFilename(artist_name)} - {sanitizeFilename(track_name)}.%(ext)s"
-            output_path = os.path.join(output_folder, output_filename)
-            
-            if prefer_flac:
-                # Try FLAC first, fallback to MP3 if FLAC fails
-                formats_tried.append('FLAC')
-                cmd = [
-                    'yt-dlp',
-                    '--format', 'bestaudio[ext=flac]/bestaudio[acodec*=flac]/bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best[height<=480]',
-                    '--extract-audio',
-                    '--audio-format', 'flac',
-                    '--audio-quality', '0',  # Best quality
-                    '--output', output_path,
-                    '--no-playlist',
-                    '--embed-metadata',
-                    '--ignore-errors',
-                    '--no-post-overwrites',
-                    '--prefer-free-formats',
-                ]
-                
-                logging.info(f"🎵 Requesting FLAC output for '{artist_name} - {track_name}'")
-            else:
-                # MP3 only mode
-                formats_tried.append('MP3')
-                cmd = [
-                    'yt-dlp',
-                    '--format', 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best[height<=480]',
-                    '--extract-audio',
-                    '--audio-format', 'mp3',
-                    '--audio-quality', '0',  # Best quality
-                    '--output', output_path,
-                    '--no-playlist',
-                    '--embed-metadata',
-                    '--ignore-errors',
-                    '--no-post-overwrites',
-                    '--prefer-free-formats',
-                ]
-                
-                logging.info(f"🎵 Requesting MP3 output for '{artist_name} - {track_name}'")
-            
-            # Try to specify ffmpeg path explicitly if available
-            ffmpeg_path = None
+        engine = get_ytdlp_engine()
+        output_base = os.path.join(output_folder, f"{sanitizeFilename(artist_name)} - {sanitizeFilename(track_name)}")
+        metadata = {'artist': artist_name, 'title': track_name, 'album_artist': artist_name}
+        
+        # Fetch the audio stream once; FLAC and the MP3 fallback are both encoded locally from it
+        download_limiter.wait(urlparse(youtube_url).netloc or YOUTUBE_HOST)
+        logging.info(f"⬇️  Downloading via yt-dlp: {youtube_url}")
+        source = engine.fetch_audio(youtube_url, 'flac' if prefer_flac else 'mp3')
+        
+        if source:
             try:
-                ffmpeg_result = subprocess.run(['which', 'ffmpeg'], capture_output=True, text=True)
-                if ffmpeg_result.returncode == 0:
-                    ffmpeg_path = ffmpeg_result.stdout.strip()
-                    cmd.extend(['--ffmpeg-location', ffmpeg_path])
-            except:
-                pass
-            
-            # Add verbosity based on log level
-            if spotdl_log_level == 'DEBUG':
-                cmd.extend(['--verbose'])
-                logging.debug(f"💻 yt-dlp command: {' '.join(cmd + [youtube_url])}")
-            elif spotdl_log_level in ['ERROR', 'WARNING']:
-                cmd.extend(['--quiet'])
-            else:
-                cmd.extend(['--no-warnings'])
-            
-            cmd.append(youtube_url)
-            
-            logging.info(f"⬇️  Downloading via yt-dlp: {youtube_url}")
-            
-            # Capture output based on log level
-            capture_output = spotdl_log_level != 'DEBUG'
-            
-            process = subprocess.run(cmd, capture_output=capture_output, text=True, timeout=300)
-            
-            if process.returncode == 0:
-                # Check what files were actually created
-                files_after = set()
-                if os.path.exists(output_folder):
-                    files_after = set(os.listdir(output_folder))
-                
-                new_files = files_after - files_before
-                audio_files = [f for f in new_files if f.lower().endswith('.flac') or f.lower().endswith('.mp3')]
-                
-                if audio_files:
-                    for audio_file in audio_files:
-                        if audio_file.lower().endswith('.flac'):
-                            logging.info(f"🎵 Successfully downloaded FLAC: {audio_file}")
-                            track_download_success()
-                        else:
-                            logging.info(f"✅ Successfully downloaded MP3: {audio_file}")
-                            track_download_success()
-                    return True
-                else:
-                    if prefer_flac:
-                        logging.warning(f"⚠️  FLAC download failed, trying MP3 fallback...")
-                    else:
-                        logging.warning(f"⚠️  MP3 download failed")
-                        track_download_failure()
-                        return False
-            
-            # If FLAC failed and we're in FLAC mode, try MP3 fallback
-            if prefer_flac:
-                formats_tried.append('MP3 (fallback)')
-                logging.info(f"🔄 FLAC download failed, trying MP3 fallback for '{artist_name} - {track_name}'")
-                
-                cmd_mp3 = [
-                    'yt-dlp',
-                    '--format', 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best[height<=480]',
-                    '--extract-audio',
-                    '--audio-format', 'mp3',
-                    '--audio-quality', '0',
-                    '--output', output_path,
-                    '--no-playlist',
-                    '--embed-metadata',
-                    '--ignore-errors',
-                    '--no-post-overwrites',
-                    '--prefer-free-formats',
-                ]
-                
-                if ffmpeg_path:
-                    cmd_mp3.extend(['--ffmpeg-location', ffmpeg_path])
-                
-                if spotdl_log_level == 'DEBUG':
-                    cmd_mp3.extend(['--verbose'])
-                elif spotdl_log_level in ['ERROR', 'WARNING']:
-                    cmd_mp3.extend(['--quiet'])
-                else:
-                    cmd_mp3.extend(['--no-warnings'])
-                
-                cmd_mp3.append(youtube_url)
-                
-                process_mp3 = subprocess.run(cmd_mp3, capture_output=capture_output, text=True, timeout=300)
-                
-                if process_mp3.returncode == 0:
-                    files_after = set()
-                    if os.path.exists(output_folder):
-                        files_after = set(os.listdir(output_folder))
+                # Try FLAC first with MP3 as fallback, or MP3 only
+                attempts = [('flac', 'FLAC'), ('mp3', 'MP3 (fallback)')] if prefer_flac else [('mp3', 'MP3')]
+                for audio_format, label in attempts:
+                    formats_tried.append(label)
+                    logging.info(f"🎵 Encoding {audio_format.upper()} output for '{artist_name} - {track_name}'")
                     
-                    new_files = files_after - files_before
-                    audio_files = [f for f in new_files if f.lower().endswith('.flac') or f.lower().endswith('.mp3')]
+                    if engine.transcode(source, output_base, audio_format, metadata):
+                        # Check what files were actually created
+                        files_after = _list_after_write(output_folder)
+                        
+                        new_files = files_after - files_before
+                        audio_files = [f for f in new_files if f.lower().endswith('.flac') or f.lower().endswith('.mp3')]
+                        
+                        if audio_files:
+                            for audio_file in audio_files:
+                                if audio_file.lower().endswith('.flac'):
+                                    logging.info(f"🎵 Successfully downloaded FLAC: {audio_file}")
+                                else:
+                                    logging.info(f"✅ Successfully downloaded MP3: {audio_file}")
+                                track_download_success()
+                            return os.path.join(output_folder, audio_files[0])
                     
-                    if audio_files:
-                        for audio_file in audio_files:
-                            logging.info(f"✅ Successfully downloaded MP3 fallback: {audio_file}")
-                            track_download_success()
-                        return True
-                
-        except subprocess.TimeoutExpired:
-            logging.error(f"⏰ yt-dlp timeout for {artist_name} - {track_name}")
-            formats_tried.append('YouTube (timeout)')
-        except Exception as e:
-            logging.error(f"💥 yt-dlp error: {e}")
+                    logging.warning(f"⚠️  {audio_format.upper()} encoding failed for '{artist_name} - {track_name}'")
+            finally:
+                engine.discard(source)
+        else:
             formats_tried.append('YouTube (error)')
-    
+        
     # If YouTube approach fails completely, try spotdl as last resort
     formats_tried.append('spotdl')
     logging.warning(f"🔄 YouTube download failed, trying spotdl as last resort for '{artist_name} - {track_name}'")
@@ -531,15 +561,14 @@ def downloadSpotifyTrack(track_uri: str, output_folder: str, track_name: str, ar
             '--audio', 'youtube',
             '--no-cache',
             '--dont-filter-results',
-            '--log-level', spotdl_log_level,
+            '--log-level', config.spotdl_log_level,
         ]
         
+        download_limiter.wait(YOUTUBE_HOST)
         process = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
         
         if process.returncode == 0:
-            files_after = set()
-            if os.path.exists(output_folder):
-                files_after = set(os.listdir(output_folder))
+            files_after = _list_after_write(output_folder)
             
             new_files = files_after - files_before
             audio_files = [f for f in new_files if f.lower().endswith('.flac') or f.lower().endswith('.mp3')]
@@ -548,7 +577,7 @@ def downloadSpotifyTrack(track_uri: str, output_folder: str, track_name: str, ar
                 format_used = 'flac' if any(f.lower().endswith('.flac') for f in audio_files) else 'mp3'
                 logging.info(f"✅ spotdl succeeded: {', '.join(audio_files)}")
                 track_download_success()
-                return True
+                return os.path.join(output_folder, audio_files[0])
         
         logging.error(f"❌ All download methods failed for '{artist_name} - {track_name}'")
         track_download_failure()
@@ -559,34 +588,106 @@ def downloadSpotifyTrack(track_uri: str, output_folder: str, track_name: str, ar
         track_download_failure()
         return False
 
+# Characters that are invalid in filenames, all replaced by '_'
+_INVALID_FILENAME_CHARS = '<>:"/\\|?*'
+_FILENAME_BYTES_TABLE = bytes.maketrans(_INVALID_FILENAME_CHARS.encode('ascii'), b'_' * len(_INVALID_FILENAME_CHARS))
+_FILENAME_TABLE = str.maketrans(_INVALID_FILENAME_CHARS, '_' * len(_INVALID_FILENAME_CHARS))
+
 def sanitizeFilename(name: str) -> str:
     """
     Removes or replaces characters that are invalid in filenames.
     """
-    invalid_chars = ['<', '>', ':', '"', '/', '\\', '|', '?', '*']
-    for char in invalid_chars:
-        name = name.replace(char, '_')
-    return name.strip()
+    # Same ASCII fast path as normalize_for_matching
+    if name.isascii():
+        return name.encode('ascii').translate(_FILENAME_BYTES_TABLE).decode('ascii').strip()
+    return name.translate(_FILENAME_TABLE).strip()
+
+# Music library sections per Plex server, by title; kept between sync cycles
+_music_sections = {}
+_music_sections_lock = threading.Lock()
+
+def get_music_sections(plex: PlexServer, refresh: bool = False) -> Dict[str, object]:
+    """
+    Returns the music library sections by title. The listing is cached between
+    cycles and only reloaded on refresh.
+    """
+    server_key = getattr(plex, '_baseurl', None)
+    with _music_sections_lock:
+        sections = _music_sections.get(server_key)
+        if sections is None or refresh:
+            sections = {section.title: section for section in plex.library.sections() if section.type == 'artist'}
+            _music_sections[server_key] = sections
+        return sections
+
+def get_music_section(plex: PlexServer, title: str):
+    """
+    Returns the cached music section with this title, reloading the section
+    listing once if it is unknown (e.g. a library was added since).
+    """
+    section = get_music_sections(plex).get(title) or get_music_sections(plex, refresh=True).get(title)
+    # Let Plex raise its usual NotFound error for libraries that really don't exist
+    return section or plex.library.section(title)
+
+def _one_star_entry(track) -> Optional[Dict]:
+    if getattr(track, 'userRating', None) not in [1.0, 2.0]:
+        return None
+    return {
+        'plex_track': track,
+        'title': track.title,
+        'artist': track.grandparentTitle or 'Unknown'
+    }
+
+def get_low_rated_tracks_by_section(plex: PlexServer) -> Optional[Dict[str, List[Dict]]]:
+    """
+    Finds the 1-star tracks of every library with a single (paged) query and groups
+    them by library section title, in the format returned by get_one_star_tracks.
+    Returns None if the query failed, so callers can fall back to per-library lookups.
+    """
+    logging.info("🔍 Fetching 1-star rated tracks from all Plex libraries...")
+    args = dict(LOW_RATING_FILTERS, type=PLEX_TRACK_TYPE)
+    try:
+        rated_tracks = plex.fetchItems(f'/library/all{joinArgs(args)}', container_size=PLEX_PAGE_SIZE)
+    except Exception as e:
+        logging.error(f"❌ Error fetching 1-star tracks across libraries: {e}")
+        return None
+    
+    by_section = {}
+    section_titles = None
+    for track in rated_tracks:
+        entry = _one_star_entry(track)
+        if not entry:
+            continue
+        section_title = getattr(track, 'librarySectionTitle', None)
+        if not section_title:
+            if section_titles is None:
+                section_titles = {str(section.key): title for title, section in get_music_sections(plex).items()}
+            section_title = section_titles.get(str(track.librarySectionID), 'Unknown')
+        by_section.setdefault(section_title, []).append(entry)
+    
+    total = sum(len(tracks) for tracks in by_section.values())
+    logging.info(f"📊 Found {total} tracks with 1-star rating in {len(by_section)} libraries.")
+    return by_section
 
 def get_one_star_tracks(plex: PlexServer, playlist_name: str) -> List[Dict]:
     """
     Retrieves all tracks from Plex that have a 1-star rating.
     Searches in the Plex library section matching the playlist name.
+    
+    The rating filter runs on the Plex server (userRating is on a 0-10 scale, so
+    1 star is 2.0) and results are paged, so only rated-down tracks are transferred.
+    The artist comes from grandparentTitle instead of a lookup per track.
     """
     logging.info(f"🔍 Fetching 1-star rated tracks from Plex library: {playlist_name}...")
     one_star_tracks = []
     
     try:
-        music_library = plex.library.section(playlist_name)
-        all_tracks = music_library.searchTracks()
+        music_library = get_music_section(plex, playlist_name)
+        rated_tracks = music_library.searchTracks(
+            filters=LOW_RATING_FILTERS,
+            container_size=PLEX_PAGE_SIZE,
+        )
         
-        for track in all_tracks:
-            if hasattr(track, 'userRating') and track.userRating in [1.0, 2.0]:
-                one_star_tracks.append({
-                    'plex_track': track,
-                    'title': track.title,
-                    'artist': track.artist().title if track.artist() else 'Unknown'
-                })
+        one_star_tracks = [entry for entry in map(_one_star_entry, rated_tracks) if entry]
                 
         logging.info(f"📊 Found {len(one_star_tracks)} tracks with 1-star rating in {playlist_name}.")
     except Exception as e:
@@ -600,7 +701,7 @@ def delete_plex_track(track, playlist_name: str = "Unknown"):
     Tracks success/failure for recap.
     """
     failed_platforms = []
-    artist_name = track.artist().title if track.artist() else 'Unknown Artist'
+    artist_name = track.grandparentTitle or 'Unknown Artist'
     track_title = track.title
     
     try:
@@ -624,7 +725,8 @@ def delete_plex_track(track, playlist_name: str = "Unknown"):
         logging.error(f"❌ Error deleting track {track_title}: {e}")
         track_deletion_failure()
 
-# Global statistics tracking
+# Global statistics tracking, shared by the download worker threads
+_stats_lock = threading.Lock()
 download_stats = {
     'downloads_attempted': 0,
     'downloads_successful': 0,
@@ -636,29 +738,39 @@ download_stats = {
 def reset_stats():
     """Reset statistics for a new sync cycle."""
     global download_stats
-    download_stats = {
-        'downloads_attempted': 0,
-        'downloads_successful': 0,
-        'downloads_failed': 0,
-        'tracks_deleted': 0,
-        'delete_failures': 0
-    }
+    with _stats_lock:
+        download_stats = {
+            'downloads_attempted': 0,
+            'downloads_successful': 0,
+            'downloads_failed': 0,
+            'tracks_deleted': 0,
+            'delete_failures': 0
+        }
+    retry_policy.start_cycle()
+
+def _increment_stat(key: str):
+    with _stats_lock:
+        download_stats[key] += 1
+
+def track_download_attempt():
+    """Track a download attempt."""
+    _increment_stat('downloads_attempted')
 
 def track_download_success():
     """Track a successful download."""
-    download_stats['downloads_successful'] += 1
+    _increment_stat('downloads_successful')
 
 def track_download_failure():
     """Track a failed download."""
-    download_stats['downloads_failed'] += 1
+    _increment_stat('downloads_failed')
 
 def track_deletion_success():
     """Track a successful deletion."""
-    download_stats['tracks_deleted'] += 1
+    _increment_stat('tracks_deleted')
 
 def track_deletion_failure():
     """Track a failed deletion."""
-    download_stats['delete_failures'] += 1
+    _increment_stat('delete_failures')
 
 def print_sync_recap():
     """Print comprehensive sync statistics."""
@@ -675,4 +787,9 @@ def print_sync_recap():
         success_rate = (download_stats['downloads_successful'] / download_stats['downloads_attempted']) * 100
         print(f"📈 Success Rate: {success_rate:.1f}%")
     
+    retries = retry_policy.metrics
+    print(f"🔁 API Retries: {retries['retries']} over {retries['calls']} calls ({retries['sleep_seconds']:.1f}s spent waiting)")
+    if retries['failures']:
+        print(f"⛔ API Calls Given Up: {retries['failures']}")
+    
     print("="*60 + "\n")
\ No newline at end of file
@@ -0,0 +1,109 @@
+"""
+search_cache.py - Persistent YouTube search result cache for Plexify
+
+This module stores YouTube search results in SQLite so they survive container
+restarts. Entries are keyed by Spotify track ID and search query. Positive and
+negative results expire after separate TTLs, so a track whose search came up
+empty is retried after a while instead of being blocked forever. The cache is
+bounded in size and evicts the least recently used entries first.
+
+Key classes/functions:
+- SearchCache: SQLite-backed search cache with TTLs and LRU eviction
+- get_search_cache: Returns the shared cache for a music path
+"""
+
+import os
+import logging
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+SEARCH_CACHE_FILENAME = '.plexify_search_cache.sqlite'
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_search_cache(music_path: Optional[str]) -> 'SearchCache':
+    """
+    Returns the process-wide search cache stored under music_path, opening it on first use.
+    Without a music path the cache only lives in memory.
+    """
+    with _caches_lock:
+        cache = _caches.get(music_path)
+        if cache is None:
+            db_path = os.path.join(music_path, SEARCH_CACHE_FILENAME) if music_path else ':memory:'
+            cache = SearchCache(
+                db_path,
+                positive_ttl=float(os.environ.get('SEARCH_CACHE_TTL', 30 * 24 * 3600)),
+                negative_ttl=float(os.environ.get('SEARCH_CACHE_NEGATIVE_TTL', 6 * 3600)),
+                max_entries=int(os.environ.get('SEARCH_CACHE_SIZE', 20000)),
+            )
+            _caches[music_path] = cache
+        return cache
+
+class SearchCache:
+    """
+    Search results keyed by (track_id, query). A stored URL of None is a negative result.
+    Safe to use from the download worker threads.
+    """
+    def __init__(self, db_path: str, positive_ttl: float, negative_ttl: float, max_entries: int):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+
+        try:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️  Could not open search cache at '{db_path}', using in-memory cache: {e}")
+            self._db = sqlite3.connect(':memory:', check_same_thread=False)
+
+        with self._db:
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS searches (
+                    track_id TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    url TEXT,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (track_id, query)
+                )
+            ''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS searches_last_used ON searches (last_used)')
+
+    def get(self, track_id: Optional[str], query: str) -> Tuple[bool, Optional[str]]:
+        """
+        Returns (hit, url). Expired entries are dropped and reported as a miss.
+        """
+        key = (track_id or '', query)
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute(
+                'SELECT url, created FROM searches WHERE track_id = ? AND query = ?', key
+            ).fetchone()
+            if row is None:
+                return False, None
+            url, created = row
+            ttl = self.positive_ttl if url else self.negative_ttl
+            if now - created > ttl:
+                self._db.execute('DELETE FROM searches WHERE track_id = ? AND query = ?', key)
+                return False, None
+            self._db.execute(
+                'UPDATE searches SET last_used = ? WHERE track_id = ? AND query = ?', (now,) + key
+            )
+            return True, url
+
+    def put(self, track_id: Optional[str], query: str, url: Optional[str]):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO searches (track_id, query, url, created, last_used) VALUES (?, ?, ?, ?, ?)',
+                (track_id or '', query, url, now, now),
+            )
+            count = self._db.execute('SELECT COUNT(*) FROM searches').fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute(
+                    'DELETE FROM searches WHERE rowid IN (SELECT rowid FROM searches ORDER BY last_used LIMIT ?)',
+                    (count - self.max_entries,),
+                )
@@ -6,16 +6,90 @@ parsing URIs, fetching user playlists, and retrieving all tracks from a playlist
 
 Key functions:
 - parseSpotifyURI: Parse Spotify URI into components.
+- formatSpotifyURI: Turn parsed URI components back into a URI string.
 - getSpotifyPlaylist: Fetch a specific playlist by ID.
 - getSpotifyUserPlaylists: Fetch all playlists for a given user.
+- getSpotifyUserPlaylistsMetadata: List id/name/snapshot_id of a user's playlists without fetching tracks.
 - getSpotifyTracks: Fetch all tracks from a playlist object.
+- iterSpotifyTracks: Stream the tracks of a playlist page by page.
+- getSpotifyPlaylistTracks: Fetch every track of a playlist by ID.
+- getCachedPlaylistTracks: Get a playlist's tracks from the cache, fetching only if incomplete.
+- buildTrackMatchIndex: Index tracks by normalized title and artist.
+- diffPlaylistTracks: Split track IDs into added, removed and unchanged sets.
+- compactPlaylist / compactTrackItem: Strip API payloads down to the fields Plexify uses.
+- removeTracksFromPlaylist: Batched track removal with per-track failure reporting.
+- forgetPlaylistTracks: Update a cached playlist after tracks were removed.
+- RateLimitedSpotify: Client wrapper sharing one token-bucket rate limit across all Spotify calls.
+- createSpotifyClient: Create a rate-limited client whose HTTP session leaves 429s to RateLimitedSpotify.
 """
 
+import os
 import re
 import logging
+import functools
+import requests
 import spotipy
-from typing import List, Dict
-from common_utils import retry_with_backoff
+from typing import Iterator, List, Dict
+from common_utils import retry_with_backoff, TokenBucket, normalize_for_matching
+
+# HTTP statuses spotipy retries by itself; 429 is left to RateLimitedSpotify (see createSpotifyClient)
+SPOTIFY_RETRY_CODES = (500, 502, 503, 504)
+
+# Process-wide Spotify API budget (SPOTIFY_RATE calls/s, bursts of SPOTIFY_BURST)
+spotify_rate_limiter = TokenBucket(
+    float(os.environ.get('SPOTIFY_RATE', '10')),
+    float(os.environ.get('SPOTIFY_BURST', '10')),
+)
+
+class RateLimitedSpotify:
+    """
+    Wraps a spotipy.Spotify client so every API call takes a token from the shared
+    spotify_rate_limiter. A 429 pauses all callers for its Retry-After and the call
+    is retried here. Safe to share between worker threads.
+    """
+    max_rate_limit_retries = 3
+
+    def __init__(self, spotify_client, limiter: TokenBucket = None):
+        if isinstance(spotify_client, RateLimitedSpotify):
+            spotify_client = spotify_client._spotify
+        self._spotify = spotify_client
+        self._limiter = limiter or spotify_rate_limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._spotify, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def rate_limited_method(*args, **kwargs):
+            for attempt in range(self.max_rate_limit_retries + 1):
+                self._limiter.acquire()
+                try:
+                    result = attr(*args, **kwargs)
+                except spotipy.exceptions.SpotifyException as e:
+                    if e.http_status != 429 or attempt == self.max_rate_limit_retries:
+                        raise
+                    self._limiter.penalize(float((e.headers or {}).get('Retry-After', 1)))
+                    continue
+                self._limiter.reward()
+                return result
+        return rate_limited_method
+
+def createSpotifyClient(**kwargs) -> RateLimitedSpotify:
+    """
+    Creates a spotipy client (kwargs as for spotipy.Spotify) wrapped in RateLimitedSpotify.
+    
+    urllib3 retries any 429 that carries a Retry-After header, even when 429 isn't in
+    status_forcelist, sleeping in the calling thread only. The session's retry policy is
+    therefore rebuilt to ignore Retry-After, so 429s reach RateLimitedSpotify and pause
+    every caller through the shared limiter.
+    """
+    sp = spotipy.Spotify(status_forcelist=SPOTIFY_RETRY_CODES, **kwargs)
+    retry = sp._session.get_adapter('https://').max_retries
+    adapter = requests.adapters.HTTPAdapter(max_retries=retry.new(respect_retry_after_header=False))
+    sp._session.mount('http://', adapter)
+    sp._session.mount('https://', adapter)
+    return RateLimitedSpotify(sp)
 
 # Parses a Spotify URI into its components (e.g., user, playlist)
 # - uriString: The Spotify URI to parse
@@ -36,62 +110,250 @@ def parseSpotifyURI(uriString: str) -> {}:
     logging.debug(f"Parsed Spotify URI components: {spotifyUriParts}")
     return spotifyUriParts
 
+# Inverse of parseSpotifyURI, used as a stable key for a configured URI
+# - uriParts: Parsed URI components, e.g. {'user': 'USERNAME'}
+# Returns: The URI string, e.g. 'spotify:user:USERNAME'
+def formatSpotifyURI(uriParts: Dict) -> str:
+    return ':'.join(['spotify'] + [f"{key}:{value}" for key, value in uriParts.items()])
+
 # Retrieves a specific Spotify playlist
 # - sp: The Spotify client instance
 # - userId: The ID of the Spotify user
 # - playlistId: The ID of the Spotify playlist
-# Returns: The Spotify playlist object
+# Returns: The Spotify playlist object, compacted to the fields Plexify uses
 def getSpotifyPlaylist(sp: spotipy.client, userId: str, playlistId: str) -> []:
     logging.info(f"Retrieving Spotify playlist for user: {userId}, playlist ID: {playlistId}")
-    playlist = retry_with_backoff(sp.user_playlist, userId, playlistId)
-    logging.debug(f"Retrieved playlist: {playlist}")
+    playlist = compactPlaylist(retry_with_backoff(sp.user_playlist, userId, playlistId))
+    logging.debug(f"Retrieved playlist: {playlist['name']} ({len(playlist['tracks']['items'])} tracks in first page)")
     return playlist
 
 # Retrieves all playlists for a specific Spotify user
+# Lists playlist metadata first and only fetches full playlists (with tracks) that are needed
 # - sp: The Spotify client instance
 # - userId: The ID of the Spotify user
+# - only_ids: If given, only these playlists are fetched in full
+# - metadata: A listing from getSpotifyUserPlaylistsMetadata to reuse instead of listing again
 # Returns: A list of Spotify playlists
-def getSpotifyUserPlaylists(sp: spotipy.client, userId: str) -> []:
+def getSpotifyUserPlaylists(sp: spotipy.client, userId: str, only_ids: List[str] = None, metadata: List[Dict] = None) -> []:
     logging.info(f"Retrieving all playlists for Spotify user: {userId}")
-    playlists = retry_with_backoff(sp.user_playlists, userId)
+    if metadata is None:
+        metadata = getSpotifyUserPlaylistsMetadata(sp, userId)
+    wanted_ids = set(only_ids) if only_ids else None
     spotifyPlaylists = []
+    for playlist in metadata:
+        if wanted_ids is not None and playlist['id'] not in wanted_ids:
+            continue
+        logging.debug(f"Adding playlist: {playlist['name']} (ID: {playlist['id']})")
+        spotifyPlaylists.append(getSpotifyPlaylist(sp, userId, playlist['id']))
+    logging.info(f"Retrieved {len(spotifyPlaylists)} of {len(metadata)} playlists for user: {userId}")
+    return spotifyPlaylists
+
+# Retrieves lightweight metadata for all playlists owned by a Spotify user
+# Uses only the paged playlist listing (one API call per 50 playlists), no track payloads
+# - sp: The Spotify client instance
+# - userId: The ID of the Spotify user
+# Returns: A list of dicts with id, name, snapshot_id and the track total
+def getSpotifyUserPlaylistsMetadata(sp: spotipy.client, userId: str) -> []:
+    logging.debug(f"Listing playlist metadata for Spotify user: {userId}")
+    playlists = retry_with_backoff(sp.user_playlists, userId, limit=50)
+    metadata = []
     while playlists:
-        playlistItems = playlists['items']
-        logging.debug(f"Processing {len(playlistItems)} playlists for user: {userId}")
-        for i, playlist in enumerate(playlistItems):
-            if playlist['owner']['id'] == userId:
-                logging.debug(f"Adding playlist: {playlist['name']} (ID: {playlist['id']})")
-                spotifyPlaylists.append(getSpotifyPlaylist(sp, userId, playlist['id']))
+        for playlist in playlists['items']:
+            if playlist and playlist['owner']['id'] == userId:
+                metadata.append({
+                    'id': playlist['id'],
+                    'name': playlist['name'],
+                    'snapshot_id': playlist.get('snapshot_id'),
+                    'tracks_total': (playlist.get('tracks') or {}).get('total', 0),
+                })
         if playlists['next']:
             playlists = retry_with_backoff(sp.next, playlists)
         else:
             playlists = None
-    logging.info(f"Retrieved {len(spotifyPlaylists)} playlists for user: {userId}")
-    return spotifyPlaylists
+    logging.debug(f"Listed {len(metadata)} playlists for user: {userId}")
+    return metadata
 
 # Retrieves all tracks from a Spotify playlist
 # - sp: The Spotify client instance
 # - playlist: The Spotify playlist object
 # Returns: A list of tracks in the playlist
 def getSpotifyTracks(sp: spotipy.client, playlist: []) -> []:
+    return list(iterSpotifyTracks(sp, playlist))
+
+# Yields the tracks of a playlist one page at a time, fetching the next page only when needed
+# - sp: The Spotify client instance
+# - playlist: The playlist object whose 'tracks' holds the first page
+# Returns: A generator of playlist track items
+def iterSpotifyTracks(sp: spotipy.client, playlist: Dict) -> Iterator[Dict]:
     logging.info(f"Retrieving tracks for playlist: {playlist['name']}")
-    spotifyTracks = []
     tracks = playlist['tracks']
-    spotifyTracks.extend(tracks['items'])
+    total = len(tracks['items'])
     logging.debug(f"Retrieved {len(tracks['items'])} initial tracks for playlist: {playlist['name']}")
+    yield from tracks['items']
     while tracks['next']:
         tracks = retry_with_backoff(sp.next, tracks)
-        spotifyTracks.extend(tracks['items'])
+        total += len(tracks['items'])
         logging.debug(f"Retrieved additional {len(tracks['items'])} tracks for playlist: {playlist['name']}")
-    logging.info(f"Retrieved total {len(spotifyTracks)} tracks for playlist: {playlist['name']}")
-    return spotifyTracks
+        yield from tracks['items']
+    logging.info(f"Retrieved total {total} tracks for playlist: {playlist['name']}")
+
+# Retrieves every track of a playlist by ID, following all pages
+# - sp: The Spotify client instance
+# - playlistId: The ID of the playlist
+# Returns: A list of compact playlist track items
+def getSpotifyPlaylistTracks(sp: spotipy.client, playlistId: str) -> List[Dict]:
+    page = retry_with_backoff(sp.playlist_items, playlistId,
+                              fields='items(track(id,name,uri,artists(name),album(name))),next',
+                              additional_types=('track',))
+    items = [compactTrackItem(item) for item in page['items']]
+    while page.get('next'):
+        page = retry_with_backoff(sp.next, page)
+        items.extend(compactTrackItem(item) for item in page['items'])
+    logging.debug(f"Retrieved {len(items)} tracks for playlist ID: {playlistId}")
+    return items
+
+# Returns a playlist's tracks for matching, from the cache when possible
+# - sp: The Spotify client instance
+# - playlist: A playlist from this cycle's sync; its snapshot was already checked
+# Returns: The cached track items if the cached list is complete, otherwise all tracks fetched from Spotify
+def getCachedPlaylistTracks(sp: spotipy.client, playlist: Dict) -> List[Dict]:
+    tracks = playlist.get('tracks') or {}
+    if tracks.get('items') is not None and not tracks.get('next'):
+        logging.debug(f"Using {len(tracks['items'])} cached tracks for playlist: {playlist.get('name')}")
+        return tracks['items']
+    return getSpotifyPlaylistTracks(sp, playlist['id'])
+
+# Builds a lookup of normalized (title, artist) pairs to track IDs
+# - items: Playlist track items; every artist of a track gets an entry
+# Returns: A dictionary keyed by (normalized title, normalized artist)
+def buildTrackMatchIndex(items: List[Dict]) -> Dict[tuple, str]:
+    index = {}
+    for item in items:
+        track = item.get('track')
+        if not track or not track.get('id'):
+            continue
+        title = normalize_for_matching(track.get('name'))
+        for artist in track.get('artists') or []:
+            index.setdefault((title, normalize_for_matching(artist.get('name'))), track['id'])
+    return index
+
+# Reduces a playlist track item to the fields Plexify uses
+# - item: A playlist track item from the Spotify API
+# Returns: A compact copy with only track id/name/uri, artist names and album name
+def compactTrackItem(item: Dict) -> Dict:
+    track = item.get('track')
+    if not track:
+        return {'track': None}
+    return {'track': {
+        'id': track.get('id'),
+        'name': track.get('name'),
+        'uri': track.get('uri'),
+        'artists': [{'name': artist.get('name')} for artist in track.get('artists') or []],
+        'album': {'name': (track.get('album') or {}).get('name')},
+    }}
+
+# Reduces a Spotify playlist object to the fields Plexify uses
+# - playlist: The Spotify playlist object (full API payload or already compact)
+# Returns: A compact copy keeping id, name, snapshot_id, the tracks page and local track map
+def compactPlaylist(playlist: Dict) -> Dict:
+    tracks = playlist.get('tracks') or {}
+    compact = {
+        'id': playlist.get('id'),
+        'name': playlist.get('name'),
+        'snapshot_id': playlist.get('snapshot_id'),
+        'tracks': {
+            'items': [compactTrackItem(item) for item in tracks.get('items') or []],
+            'next': tracks.get('next'),
+            'total': tracks.get('total'),
+        },
+    }
+    if playlist.get('local_tracks'):
+        compact['local_tracks'] = playlist['local_tracks']
+    # The configured URI the playlist was found through (see formatSpotifyURI)
+    if playlist.get('source'):
+        compact['source'] = playlist['source']
+    return compact
+
+# Compares previously known track IDs of a playlist with its current ones
+# - cached_ids: Track IDs from the last sync
+# - fresh_ids: Track IDs currently in the playlist
+# Returns: (added, removed, unchanged) sets of track IDs
+def diffPlaylistTracks(cached_ids, fresh_ids) -> (set, set, set):
+    cached_ids = set(cached_ids)
+    fresh_ids = set(fresh_ids)
+    return fresh_ids - cached_ids, cached_ids - fresh_ids, fresh_ids & cached_ids
+
+# Maximum number of items Spotify accepts per playlist removal request
+REMOVE_BATCH_SIZE = 100
+
+def removeTracksFromPlaylist(sp: spotipy.Spotify, playlistId: str, trackIds: List[str], cachedSnapshotId: str = None):
+    """
+    Removes tracks from a Spotify playlist in batches of up to 100 IDs.
+    If a batch is rejected, its tracks are retried one by one so failures are
+    reported per track. An authorization error (401/403, e.g. in read-only mode)
+    would reject every track alike, so it fails all remaining tracks at once.
+    
+    Returns (removed_ids, failed, snapshot_id) where failed maps track IDs to the
+    error message and snapshot_id is the playlist snapshot after the last removal.
+    The new snapshot also covers edits made on Spotify since the playlist was cached,
+    so it is only returned if cachedSnapshotId is still the playlist's current
+    snapshot before the removal; otherwise (or if nothing was removed) it is None
+    and the cached snapshot must be kept, so the next check refetches the playlist.
+    """
+    removed, failed = [], {}
+    snapshot_id = None
+    unique_ids = list(dict.fromkeys(trackIds))
+    inSync = False
+    if cachedSnapshotId and unique_ids:
+        try:
+            current = retry_with_backoff(sp.playlist, playlistId, fields='snapshot_id')
+            inSync = (current or {}).get('snapshot_id') == cachedSnapshotId
+        except Exception as e:
+            logging.warning(f"⚠️  Could not check the snapshot of playlist {playlistId}: {e}")
+        if not inSync:
+            logging.debug(f"Playlist {playlistId} changed since it was cached, keeping its cached snapshot")
+    
+    for start in range(0, len(unique_ids), REMOVE_BATCH_SIZE):
+        batch = unique_ids[start:start + REMOVE_BATCH_SIZE]
+        try:
+            result = retry_with_backoff(sp.playlist_remove_all_occurrences_of_items, playlistId, batch)
+            snapshot_id = (result or {}).get('snapshot_id', snapshot_id)
+            removed.extend(batch)
+            continue
+        except Exception as e:
+            cause = e.__cause__ or e
+            if getattr(cause, 'http_status', None) in (401, 403):
+                logging.error(f"🔒 Not allowed to modify playlist {playlistId}, skipping {len(unique_ids) - start} removals: {e}")
+                failed.update((trackId, str(e)) for trackId in unique_ids[start:])
+                break
+            logging.warning(f"⚠️  Batch removal from playlist {playlistId} failed, retrying {len(batch)} tracks individually: {e}")
+        for trackId in batch:
+            try:
+                result = retry_with_backoff(sp.playlist_remove_all_occurrences_of_items, playlistId, [trackId])
+                snapshot_id = (result or {}).get('snapshot_id', snapshot_id)
+                removed.append(trackId)
+            except Exception as e:
+                logging.error(f"Failed to remove track {trackId} from playlist {playlistId}: {e}")
+                failed[trackId] = str(e)
+    
+    if removed:
+        logging.info(f"Removed {len(removed)} tracks from playlist {playlistId}")
+    return removed, failed, snapshot_id if inSync else None
 
-def removeTrackFromPlaylist(sp: spotipy.Spotify, playlistId: str, trackId: str):
+def forgetPlaylistTracks(playlist: Dict, trackIds: List[str], snapshot_id: str = None):
     """
-    Removes a track from a Spotify playlist.
+    Drops removed tracks from a cached playlist (track list and local track map) and
+    records the playlist's new snapshot_id (if given, see removeTracksFromPlaylist),
+    so the next cycle neither refetches the playlist nor downloads the removed tracks again.
     """
-    try:
-        retry_with_backoff(sp.playlist_remove_all_occurrences_of_items, playlistId, [trackId])
-        logging.info(f"Removed track {trackId} from playlist {playlistId}")
-    except Exception as e:
-        logging.error(f"Failed to remove track {trackId} from playlist {playlistId}: {e}")
\ No newline at end of file
+    gone = set(trackIds)
+    tracks = playlist.get('tracks') or {}
+    if tracks.get('items') is not None:
+        tracks['items'] = [item for item in tracks['items'] if (item.get('track') or {}).get('id') not in gone]
+        tracks['total'] = len(tracks['items'])
+    local_tracks = playlist.get('local_tracks')
+    if local_tracks:
+        for trackId in gone:
+            local_tracks.pop(trackId, None)
+    if snapshot_id:
+        playlist['snapshot_id'] = snapshot_id
@@ -0,0 +1,130 @@
+"""
+sync_scheduler.py - Adaptive sync scheduler for Plexify
+
+This module decides when each configured Spotify URI is checked, instead of
+checking all of them every SECONDS_TO_WAIT. A spotify:playlist: URI is scheduled
+on its own; a spotify:user: URI is scheduled with all of its playlists, since one
+listing call covers up to 50 of them anyway.
+
+URIs sit in a priority queue keyed by their next due time. A URI whose playlists
+were unchanged at its last check is polled half as often (up to
+SYNC_MAX_INTERVAL), one whose playlists changed twice as often (down to
+SYNC_MIN_INTERVAL). Every Spotify call a round makes counts against an hourly
+budget (SPOTIFY_HOURLY_BUDGET); once it is spent, further checks wait until
+enough of the past hour has expired. Failed rounds are retried with an
+exponential backoff instead of a fixed delay.
+
+Key classes/functions:
+- SyncScheduler: Per-URI due times with adaptive intervals and an API budget
+"""
+
+import heapq
+import logging
+import time
+from collections import deque
+from typing import Dict, List
+from spotify_utils import formatSpotifyURI
+
+BUDGET_WINDOW = 3600
+# First retry delay after a failed round; doubles per consecutive failure
+RETRY_DELAY = 60
+
+class SyncScheduler:
+    """
+    Priority queue of configured Spotify URIs by next due time. pop_due() hands out
+    the URIs to check now; every popped URI must be handed back through record() or
+    record_failure() to be scheduled again.
+    """
+    def __init__(self, spotify_uris: List[Dict], base_interval: float = 3600, min_interval: float = 300,
+                 max_interval: float = 21600, hourly_budget: int = 0):
+        self.min_interval = max(1.0, min_interval)
+        self.max_interval = max(self.min_interval, max_interval)
+        self.hourly_budget = max(0, hourly_budget)
+        self._uris = {formatSpotifyURI(uri): uri for uri in spotify_uris if uri}
+        base_interval = min(max(base_interval, self.min_interval), self.max_interval)
+        self.intervals = {key: base_interval for key in self._uris}
+        # Estimated Spotify calls per check of a URI, learned from past rounds
+        self._costs = {key: 1.0 for key in self._uris}
+        self._signatures = {}
+        self._failures = {}
+        self._spent = deque()
+        now = time.monotonic()
+        self._queue = [(now, key) for key in self._uris]
+        heapq.heapify(self._queue)
+
+    def _remaining_budget(self, now: float) -> float:
+        while self._spent and self._spent[0][0] <= now - BUDGET_WINDOW:
+            self._spent.popleft()
+        return self.hourly_budget - sum(calls for _, calls in self._spent)
+
+    def _push(self, key: str, due: float):
+        heapq.heappush(self._queue, (due, key))
+
+    def pop_due(self) -> List[Dict]:
+        """
+        Removes and returns the URIs that are due, earliest first, as far as the
+        hourly budget allows. Returns an empty list if nothing can run yet.
+        """
+        now = time.monotonic()
+        remaining = self._remaining_budget(now) if self.hourly_budget else float('inf')
+        due = []
+        while self._queue and self._queue[0][0] <= now and remaining > 0:
+            _, key = heapq.heappop(self._queue)
+            # The first URI always runs while any budget is left, so an expensive one can't starve
+            if due and self._costs[key] > remaining:
+                self._push(key, now)
+                break
+            remaining -= self._costs[key]
+            due.append(key)
+        return [self._uris[key] for key in due]
+
+    def seconds_until_due(self) -> float:
+        """
+        Seconds until pop_due() can return something again.
+        """
+        if not self._queue:
+            return self.max_interval
+        now = time.monotonic()
+        wait = self._queue[0][0] - now
+        if self.hourly_budget and self._remaining_budget(now) <= 0:
+            # The oldest spending of the window has to expire first
+            wait = max(wait, self._spent[0][0] + BUDGET_WINDOW - now)
+        return max(0.0, wait)
+
+    def record(self, spotify_uris: List[Dict], playlists: List[Dict], api_calls: int):
+        """
+        Reschedules the URIs of a finished round. playlists are the synced playlists
+        (their 'source' ties them to a URI) and api_calls the Spotify calls the round made.
+        """
+        now = time.monotonic()
+        keys = list(dict.fromkeys(formatSpotifyURI(uri) for uri in spotify_uris))
+        if api_calls:
+            self._spent.append((now, api_calls))
+        for key in keys:
+            self._costs[key] = (self._costs[key] + api_calls / len(keys)) / 2
+            signature = frozenset((p['id'], p.get('snapshot_id')) for p in playlists or [] if p.get('source') == key)
+            previous = self._signatures.get(key)
+            self._signatures[key] = signature
+            interval = self.intervals[key]
+            # The first check only records a baseline
+            if previous is not None:
+                if signature != previous:
+                    interval = max(self.min_interval, interval / 2)
+                else:
+                    interval = min(self.max_interval, interval * 2)
+            self.intervals[key] = interval
+            self._failures.pop(key, None)
+            self._push(key, now + interval)
+            logging.debug(f"📅 Next check of {key} in {interval:.0f}s")
+
+    def record_failure(self, spotify_uris: List[Dict]):
+        """
+        Reschedules the URIs of a failed round: after RETRY_DELAY seconds, doubling
+        with every consecutive failure but never later than their regular interval.
+        """
+        now = time.monotonic()
+        for key in dict.fromkeys(formatSpotifyURI(uri) for uri in spotify_uris):
+            failures = self._failures[key] = self._failures.get(key, 0) + 1
+            delay = min(self.intervals[key], RETRY_DELAY * 2 ** (failures - 1))
+            self._push(key, now + delay)
+            logging.info(f"⏳ Retrying {key} in {delay:.0f}s (attempt {failures + 1})")
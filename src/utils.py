@@ -8,6 +8,9 @@ It also triggers the discovery playlist generation.
 
 Key functions:
 - runSync: Main entry point to start the synchronization.
+- refreshPlaylists: Loads the cache and refetches new or changed playlists.
+- get_changed_playlist_ids: Detects changed playlists from bulk snapshot listings.
+- tagPlaylistSources: Records which configured URI each playlist was found through.
 - dumpSpotifyPlaylists: Fetches and saves Spotify playlists to a JSON file.
 - diffAndSyncPlaylists: Compares Spotify and Plex playlists and syncs them.
 - parseSpotifyURI: Parses Spotify URIs into components.
@@ -18,10 +21,15 @@ import json
 import logging
 import spotipy
 from typing import List, Dict
-from spotify_utils import getSpotifyUserPlaylists, getSpotifyPlaylist
+from spotify_utils import getSpotifyUserPlaylists, getSpotifyPlaylist, getSpotifyUserPlaylistsMetadata, compactPlaylist, formatSpotifyURI
 from plex_utils import ensureLocalFiles
+from config import RuntimeConfig, get_runtime_config
+from library_index import directory_snapshots
 
-CACHE_FILE = 'spotify_playlists.json'
+# Compact cache: one playlist per line as minified JSON (see spotify_utils.compactPlaylist)
+CACHE_FILE = 'spotify_playlists.jsonl'
+# Pre-compact cache format, migrated on first load
+LEGACY_CACHE_FILE = 'spotify_playlists.json'
 
 def parseSpotifyURI(uri: str) -> Dict:
     """
@@ -51,13 +59,32 @@ def load_cached_playlists() -> List[Dict]:
     if os.path.exists(CACHE_FILE):
         try:
             with open(CACHE_FILE, 'r') as f:
-                cached = json.load(f)
+                cached = [json.loads(line) for line in f if line.strip()]
                 logging.info(f"💾 Loaded {len(cached)} playlists from cache.")
                 return cached
         except Exception as e:
             logging.warning(f"⚠️  Failed to load cache: {e}")
+    elif os.path.exists(LEGACY_CACHE_FILE):
+        try:
+            with open(LEGACY_CACHE_FILE, 'r') as f:
+                cached = [compactPlaylist(p) for p in json.load(f)]
+                logging.info(f"💾 Migrated {len(cached)} playlists from legacy cache '{LEGACY_CACHE_FILE}'.")
+                return cached
+        except Exception as e:
+            logging.warning(f"⚠️  Failed to load legacy cache: {e}")
     return None
 
+def save_cached_playlists(playlists: List[Dict]):
+    """
+    Atomically writes the playlists to CACHE_FILE, one minified JSON object per line.
+    """
+    tmp_file = f"{CACHE_FILE}.tmp"
+    with open(tmp_file, 'w') as f:
+        for playlist in playlists:
+            f.write(json.dumps(compactPlaylist(playlist), separators=(',', ':')))
+            f.write('\n')
+    os.replace(tmp_file, CACHE_FILE)
+
 def has_playlist_changed(sp: spotipy.Spotify, cached_playlist: Dict) -> bool:
     try:
         current = sp.playlist(cached_playlist['id'], fields='snapshot_id')
@@ -69,90 +96,188 @@ def has_playlist_changed(sp: spotipy.Spotify, cached_playlist: Dict) -> bool:
         logging.warning(f"⚠️  Could not check playlist changes: {e}")
         return True
 
+def get_changed_playlist_ids(sp: spotipy.Spotify, spotify_uris: List[Dict], cached_playlists: List[Dict], listings: Dict[str, List[Dict]] = None) -> List[str]:
+    """
+    Returns the IDs of playlists that are new or whose snapshot_id changed.
+    
+    For spotify:user: URIs the paged playlist listing already carries snapshot_id,
+    so snapshots are compared in bulk (one API call per 50 playlists). Only
+    spotify:playlist: URIs, and cached playlists no listing covered, are checked
+    one by one. If listings is given, the per-user listings are stored in it so
+    they can be reused when fetching the changed playlists.
+    
+    spotify_uris may be a subset of the configured URIs (see sync_scheduler); cached
+    playlists found through other URIs are then left alone.
+    """
+    cached_by_id = {p['id']: p for p in cached_playlists}
+    changed_ids = []
+    resolved = set()
+    
+    for uri in spotify_uris:
+        if 'user' in uri:
+            try:
+                listing = getSpotifyUserPlaylistsMetadata(sp, uri['user'])
+            except Exception as e:
+                logging.warning(f"⚠️  Could not list playlists for user '{uri['user']}': {e}")
+                continue
+            if listings is not None:
+                listings[uri['user']] = listing
+            for meta in listing:
+                if meta['id'] in resolved:
+                    continue
+                resolved.add(meta['id'])
+                cached = cached_by_id.get(meta['id'])
+                if not cached:
+                    logging.info(f"🆕 New playlist found: '{meta['name']}'")
+                    changed_ids.append(meta['id'])
+                elif meta['snapshot_id'] != cached.get('snapshot_id'):
+                    logging.info(f"🔄 Playlist '{cached['name']}' has changed")
+                    changed_ids.append(meta['id'])
+        elif 'playlist' in uri:
+            playlist_id = uri['playlist']
+            if playlist_id in resolved:
+                continue
+            resolved.add(playlist_id)
+            cached = cached_by_id.get(playlist_id)
+            if not cached or has_playlist_changed(sp, cached):
+                changed_ids.append(playlist_id)
+    
+    # Anything cached that no listing covered (e.g. a failed listing) is checked individually
+    sources = {formatSpotifyURI(uri) for uri in spotify_uris}
+    for cached in cached_playlists:
+        if cached.get('source') is not None and cached['source'] not in sources:
+            continue
+        if cached['id'] not in resolved and has_playlist_changed(sp, cached):
+            changed_ids.append(cached['id'])
+    
+    return changed_ids
+
 # Main function to run the synchronization process
 # - plex: The Plex server instance
 # - sp: The Spotify client instance
 # - spotify_uris: A list of parsed Spotify URIs
-def runSync(sp: spotipy.Spotify, spotify_uris: List[Dict], force_refresh: bool = False):
+def runSync(sp: spotipy.Spotify, spotify_uris: List[Dict], force_refresh: bool = False, config: RuntimeConfig = None):
     """
     Main sync function. Uses cached data when possible to minimize API calls.
+    Only spotify_uris are checked for changes (e.g. the ones sync_scheduler found due);
+    all cached playlists are still synced locally.
+    config is resolved once (by default from the environment) and used for every track.
     """
     logging.info("🔄 Starting synchronization process...")
+    config = config or get_runtime_config()
+    
+    spotifyPlaylists = refreshPlaylists(sp, spotify_uris, force_refresh)
+    
+    if syncPlaylists(sp, spotifyPlaylists, config):
+        save_cached_playlists(spotifyPlaylists)
+    logging.info("✅ Synchronization process finished.")
+    return spotifyPlaylists
+
+def refreshPlaylists(sp: spotipy.Spotify, spotify_uris: List[Dict], force_refresh: bool = False) -> List[Dict]:
+    """
+    Returns the playlists to sync this cycle: cached playlists whose snapshot is
+    unchanged, plus fresh copies of new or changed ones (saved to the cache).
+    """
+    # Folder listings are cached per cycle; start from a clean slate
+    directory_snapshots.clear()
     
     cached_playlists = None if force_refresh else load_cached_playlists()
     
     if cached_playlists:
         logging.info("📋 Using cached playlist data. Checking for changes...")
-        spotifyPlaylists = []
-        needs_update = []
-        
-        for cached in cached_playlists:
-            if has_playlist_changed(sp, cached):
-                needs_update.append(cached['id'])
-            else:
-                spotifyPlaylists.append(cached)
+        listings = {}
+        needs_update = get_changed_playlist_ids(sp, spotify_uris, cached_playlists, listings)
+        tagPlaylistSources(cached_playlists, spotify_uris, listings)
+        spotifyPlaylists = [p for p in cached_playlists if p['id'] not in needs_update]
         
         if needs_update:
             logging.info(f"🔄 {len(needs_update)} playlists need updating.")
-            fresh_playlists = dumpSpotifyPlaylists(sp, spotify_uris, only_ids=needs_update)
+            fresh_playlists = dumpSpotifyPlaylists(sp, spotify_uris, only_ids=needs_update, listings=listings)
+            cached_by_id = {p['id']: p for p in cached_playlists}
             
             for fresh in fresh_playlists:
+                # Carry over which tracks are already on disk so only the delta is processed
+                previous = cached_by_id.get(fresh['id'])
+                if previous and previous.get('local_tracks'):
+                    fresh['local_tracks'] = previous['local_tracks']
                 spotifyPlaylists = [p for p in spotifyPlaylists if p['id'] != fresh['id']]
                 spotifyPlaylists.append(fresh)
             
-            with open(CACHE_FILE, 'w') as f:
-                json.dump(spotifyPlaylists, f, indent=4)
+            save_cached_playlists(spotifyPlaylists)
         else:
             logging.info("✅ All playlists are up-to-date. No API calls needed.")
     else:
         logging.info("🔍 No cache found or forced refresh. Fetching all playlists...")
         spotifyPlaylists = dumpSpotifyPlaylists(sp, spotify_uris)
     
-    syncPlaylists(sp, spotifyPlaylists)
-    logging.info("✅ Synchronization process finished.")
     return spotifyPlaylists
 
 # Dumps all relevant Spotify playlists to a JSON file
 # - sp: The Spotify client instance
 # - spotify_uris: A list of parsed Spotify URIs
 # Returns: A list of Spotify playlists
-def dumpSpotifyPlaylists(sp: spotipy.Spotify, spotify_uris: List[Dict], only_ids: List[str] = None) -> List[Dict]:
+def dumpSpotifyPlaylists(sp: spotipy.Spotify, spotify_uris: List[Dict], only_ids: List[str] = None, listings: Dict[str, List[Dict]] = None) -> List[Dict]:
     """
     Fetches Spotify playlists based on provided URIs.
+    With only_ids, only those playlists are fetched in full; user playlist listings
+    from get_changed_playlist_ids can be passed in to avoid listing them again.
     """
     logging.info("📥 Fetching Spotify playlists...")
     spotifyPlaylists = []
     
     for uri in spotify_uris:
         if 'user' in uri:
-            user_playlists = getSpotifyUserPlaylists(sp, uri['user'])
-            if only_ids:
-                user_playlists = [p for p in user_playlists if p['id'] in only_ids]
-            spotifyPlaylists.extend(user_playlists)
+            metadata = listings.get(uri['user']) if listings else None
+            fetched = getSpotifyUserPlaylists(sp, uri['user'], only_ids=only_ids, metadata=metadata)
         elif 'playlist' in uri:
-            if not only_ids or uri['playlist'] in only_ids:
-                spotifyPlaylists.append(getSpotifyPlaylist(sp, '', uri['playlist']))
+            fetched = [getSpotifyPlaylist(sp, '', uri['playlist'])] if not only_ids or uri['playlist'] in only_ids else []
         else:
             logging.warning(f"⚠️  Unknown URI type: {uri}")
+            continue
+        for playlist in fetched:
+            playlist['source'] = formatSpotifyURI(uri)
+        spotifyPlaylists.extend(fetched)
     
     if spotifyPlaylists:
-        with open(CACHE_FILE, 'w') as f:
-            json.dump(spotifyPlaylists, f, indent=4)
+        # Partial fetches are merged into the cache by runSync
+        if not only_ids:
+            save_cached_playlists(spotifyPlaylists)
         logging.info(f"✅ Found {len(spotifyPlaylists)} Spotify playlists.")
     else:
         logging.warning("⚠️  No Spotify playlists found.")
     
     return spotifyPlaylists
 
-def syncPlaylists(sp: spotipy.Spotify, spotifyPlaylists: List[Dict]):
+def tagPlaylistSources(playlists: List[Dict], spotify_uris: List[Dict], listings: Dict[str, List[Dict]]):
+    """
+    Records on each playlist the configured URI it was found through, using the
+    user listings from get_changed_playlist_ids (caches written before sources were
+    tracked have none).
+    """
+    sources = {}
+    for uri in spotify_uris:
+        if 'user' in uri:
+            for meta in listings.get(uri['user'], []):
+                sources.setdefault(meta['id'], formatSpotifyURI(uri))
+        elif 'playlist' in uri:
+            sources[uri['playlist']] = formatSpotifyURI(uri)
+    for playlist in playlists:
+        if playlist['id'] in sources:
+            playlist['source'] = sources[playlist['id']]
+
+def syncPlaylists(sp: spotipy.Spotify, spotifyPlaylists: List[Dict], config: RuntimeConfig = None) -> bool:
     """
     Ensures local files exist for all Spotify playlists.
+    Returns True if any playlist's known local tracks changed and the cache should be saved.
     """
     if not spotifyPlaylists:
         logging.info("✨ No playlists to sync.")
-        return
+        return False
     
+    changed = False
     for playlist in spotifyPlaylists:
         playlist_name = playlist.get('name', 'Unknown')
         logging.info(f"📂 Processing playlist: {playlist_name}")
-        ensureLocalFiles(sp, playlist)
\ No newline at end of file
+        previous_tracks = playlist.get('local_tracks')
+        changed |= ensureLocalFiles(sp, playlist, config) != (previous_tracks or {})
+    return changed
\ No newline at end of file
@@ -0,0 +1,204 @@
+"""
+ytdlp_engine.py - In-process yt-dlp download engine for Plexify
+
+This module drives yt-dlp through its Python API instead of spawning the
+yt-dlp CLI for every search and download. YoutubeDL instances are created
+once per worker thread and reused, and ffmpeg is resolved once when the
+engine is created.
+
+Audio is fetched from the network once, as the best available stream, into a
+temporary download cache. FLAC/MP3 files are then produced locally with
+ffmpeg, so falling back from FLAC to MP3 reuses the downloaded bytes.
+
+Key classes/functions:
+- YtDlpEngine: Searches YouTube, fetches audio and transcodes it locally
+- get_ytdlp_engine: Returns the shared engine
+"""
+
+import os
+import logging
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Callable, Dict, List, Optional
+from config import get_runtime_config
+
+# ffmpeg encoder settings per output format (best quality, like --audio-quality 0)
+ENCODER_ARGS = {
+    'flac': ['-c:a', 'flac'],
+    'mp3': ['-c:a', 'libmp3lame', '-q:a', '0'],
+}
+
+# Source stream selectors per preferred output format (same as the former CLI invocations)
+FORMAT_SELECTORS = {
+    'flac': 'bestaudio[ext=flac]/bestaudio[acodec*=flac]/bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best[height<=480]',
+    'mp3': 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best[height<=480]',
+}
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_ytdlp_engine() -> 'YtDlpEngine':
+    """
+    Returns the process-wide engine, creating it on first use.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            config = get_runtime_config()
+            _engine = YtDlpEngine(log_level=config.spotdl_log_level, ffmpeg_location=config.ffmpeg_location,
+                                  cache_path=config.download_cache_path)
+        return _engine
+
+def _default_ydl_factory(params: Dict):
+    from yt_dlp import YoutubeDL
+    return YoutubeDL(params)
+
+def output_template(path_without_ext: str) -> str:
+    """
+    Builds a yt-dlp output template for a fixed path, escaping '%' in the path.
+    """
+    return path_without_ext.replace('%', '%%') + '.%(ext)s'
+
+class _LoggingAdapter:
+    """
+    Routes yt-dlp's output through the logging module.
+    """
+    def debug(self, msg):
+        logging.debug(f"yt-dlp: {msg}")
+
+    def info(self, msg):
+        logging.debug(f"yt-dlp: {msg}")
+
+    def warning(self, msg):
+        logging.debug(f"yt-dlp warning: {msg}")
+
+    def error(self, msg):
+        logging.warning(f"yt-dlp: {msg}")
+
+class YtDlpEngine:
+    """
+    Long-lived yt-dlp driver. YoutubeDL is not thread-safe, so each worker thread
+    gets its own instances, which are then reused for every search and download.
+    ydl_factory can be replaced to run against a fake extractor offline.
+    """
+    def __init__(self, log_level: str = 'INFO', ffmpeg_location: Optional[str] = None,
+                 ydl_factory: Callable[[Dict], object] = None, socket_timeout: int = 30,
+                 cache_path: Optional[str] = None):
+        self.log_level = log_level.upper()
+        self.ffmpeg_location = ffmpeg_location or shutil.which('ffmpeg')
+        self.socket_timeout = socket_timeout
+        self.cache_path = cache_path or os.path.join(tempfile.gettempdir(), 'plexify-downloads')
+        self._factory = ydl_factory or _default_ydl_factory
+        self._local = threading.local()
+        if not self.ffmpeg_location:
+            logging.warning("⚠️  ffmpeg not found on PATH - audio extraction will fail")
+
+    def _base_params(self) -> Dict:
+        params = {
+            'logger': _LoggingAdapter(),
+            'noplaylist': True,
+            'socket_timeout': self.socket_timeout,
+        }
+        if self.log_level == 'DEBUG':
+            params['verbose'] = True
+        else:
+            params['quiet'] = True
+            params['no_warnings'] = True
+            params['noprogress'] = True
+        return params
+
+    def _instances(self) -> Dict[str, object]:
+        instances = getattr(self._local, 'instances', None)
+        if instances is None:
+            instances = self._local.instances = {}
+        return instances
+
+    def _search_ydl(self):
+        instances = self._instances()
+        if 'search' not in instances:
+            params = self._base_params()
+            params.update({'extract_flat': 'in_playlist', 'skip_download': True})
+            instances['search'] = self._factory(params)
+        return instances['search']
+
+    def _fetch_ydl(self, audio_format: str):
+        key = f'fetch-{audio_format}'
+        instances = self._instances()
+        if key not in instances:
+            params = self._base_params()
+            params.update({
+                'format': FORMAT_SELECTORS[audio_format],
+                'outtmpl': {'default': '%(id)s.%(ext)s'},
+                'prefer_free_formats': True,
+            })
+            if self.ffmpeg_location:
+                params['ffmpeg_location'] = self.ffmpeg_location
+            instances[key] = self._factory(params)
+        return instances[key]
+
+    def search(self, query: str, count: int = 5) -> List[str]:
+        """
+        Returns the video IDs of the top YouTube search results, or an empty list on failure.
+        """
+        try:
+            info = self._search_ydl().extract_info(f'ytsearch{count}:{query}', download=False)
+        except Exception as e:
+            logging.debug(f"yt-dlp search failed for '{query}': {e}")
+            return []
+        entries = (info or {}).get('entries') or []
+        return [entry['id'] for entry in entries if entry and entry.get('id')]
+
+    def fetch_audio(self, url: str, audio_format: str) -> Optional[str]:
+        """
+        Downloads the best source stream for audio_format ('flac' or 'mp3') into a fresh
+        directory of the download cache. Returns the downloaded file, or None on failure.
+        The caller removes it with discard() once it has been transcoded.
+        """
+        os.makedirs(self.cache_path, exist_ok=True)
+        work_dir = tempfile.mkdtemp(dir=self.cache_path)
+        ydl = self._fetch_ydl(audio_format)
+        ydl.params['outtmpl']['default'] = output_template(os.path.join(work_dir, 'source'))
+        try:
+            if ydl.download([url]) == 0:
+                files = [f for f in os.listdir(work_dir) if not f.endswith('.part')]
+                if files:
+                    return os.path.join(work_dir, files[0])
+        except Exception as e:
+            logging.warning(f"⚠️  yt-dlp download failed for {url}: {e}")
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return None
+
+    def transcode(self, source: str, path_without_ext: str, audio_format: str, metadata: Dict[str, str] = None) -> Optional[str]:
+        """
+        Encodes a fetched source file to path_without_ext + '.' + audio_format with ffmpeg,
+        tagging it with metadata. Existing files are never overwritten.
+        Returns the output path, or None if encoding failed.
+        """
+        output_path = f"{path_without_ext}.{audio_format}"
+        cmd = [self.ffmpeg_location or 'ffmpeg', '-nostdin', '-n', '-loglevel', 'error', '-i', source, '-vn']
+        for key, value in (metadata or {}).items():
+            if value:
+                cmd.extend(['-metadata', f'{key}={value}'])
+        cmd.extend(ENCODER_ARGS[audio_format])
+        cmd.append(output_path)
+        try:
+            process = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logging.warning(f"⚠️  ffmpeg failed to encode {audio_format.upper()}: {e}")
+            process = None
+        if process is not None and process.returncode == 0 and os.path.exists(output_path):
+            return output_path
+        if process is not None and process.returncode != 0:
+            logging.warning(f"⚠️  ffmpeg failed to encode {audio_format.upper()}: {process.stderr.strip()}")
+            # Don't leave a partial file behind (unless ffmpeg refused to overwrite an existing one)
+            if 'already exists' not in process.stderr and os.path.exists(output_path):
+                os.remove(output_path)
+        return None
+
+    def discard(self, source: str):
+        """
+        Removes a fetched source file and its work directory from the download cache.
+        """
+        shutil.rmtree(os.path.dirname(source), ignore_errors=True)
@@ -2,8 +2,25 @@ from spotipy.oauth2 import SpotifyClientCredentials
 from unittest.mock import patch, MagicMock
 from plexapi.server import PlexServer
 from plexapi.audio import Track
+import os
+import asyncio
+import shutil
+import tempfile
+import threading
+import time
 import unittest
-from utils import runSync
+from utils import runSync, get_changed_playlist_ids, save_cached_playlists, load_cached_playlists
+from common_utils import HostRateLimiter, TokenBucket, RetryPolicy, RetryError, normalize_for_matching
+from spotify_utils import getSpotifyUserPlaylists, RateLimitedSpotify, createSpotifyClient, getSpotifyPlaylistTracks, buildTrackMatchIndex, removeTracksFromPlaylist, forgetPlaylistTracks
+from library_index import LibraryIndex, DirectorySnapshotCache
+from library_watcher import InotifyWatcher, PollingWatcher
+from plex_utils import sanitizeFilename, ensureLocalFiles, get_one_star_tracks, get_low_rated_tracks_by_section
+from search_cache import SearchCache
+from ytdlp_engine import YtDlpEngine
+from async_sync import runSyncAsync, StageLimits
+from content_store import ContentStore
+from config import RuntimeConfig
+from sync_scheduler import SyncScheduler
 
 class TestMainFunctions(unittest.TestCase):
 
@@ -16,5 +33,806 @@ class TestMainFunctions(unittest.TestCase):
 
         mock_dump_spotify.assert_called_once_with(sp, spotify_uris)
 
+    @patch('common_utils.time.sleep')
+    def test_host_rate_limiter_spaces_same_host(self, mock_sleep):
+        limiter = HostRateLimiter(10)
+
+        limiter.wait('www.youtube.com')
+        limiter.wait('www.youtube.com')
+        limiter.wait('example.com')
+
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertGreater(mock_sleep.call_args[0][0], 9)
+
+    @patch('common_utils.time.sleep')
+    @patch('common_utils.time.monotonic', return_value=100.0)
+    def test_token_bucket_allows_burst_then_paces(self, mock_monotonic, mock_sleep):
+        bucket = TokenBucket(rate=2, burst=3)
+
+        for _ in range(3):
+            bucket.acquire()
+        mock_sleep.assert_not_called()
+
+        bucket.acquire()
+        self.assertAlmostEqual(mock_sleep.call_args[0][0], 0.5)
+
+        # A 429 pauses everyone for Retry-After and halves the rate; the caller
+        # still queued from above is served first
+        bucket.penalize(10)
+        bucket.acquire()
+        self.assertAlmostEqual(mock_sleep.call_args[0][0], 10 + 2 / 1.0)
+        self.assertEqual(bucket.rate, 1.0)
+
+    def test_rate_limited_spotify_retries_429_with_retry_after(self):
+        import spotipy
+        limiter = MagicMock()
+        client = MagicMock()
+        client.playlist.side_effect = [
+            spotipy.exceptions.SpotifyException(429, -1, 'rate limited', headers={'Retry-After': '7'}),
+            {'snapshot_id': 'abc'},
+        ]
+        sp = RateLimitedSpotify(client, limiter)
+
+        self.assertEqual(sp.playlist('p1', fields='snapshot_id'), {'snapshot_id': 'abc'})
+        limiter.penalize.assert_called_once_with(7.0)
+        self.assertEqual(limiter.acquire.call_count, 2)
+        # Wrapping twice keeps a single layer of rate limiting
+        self.assertIs(RateLimitedSpotify(sp, limiter)._spotify, client)
+
+    def test_spotify_session_leaves_429_to_the_shared_limiter(self):
+        sp = createSpotifyClient(auth='token')
+        retry = sp._spotify._session.get_adapter('https://api.spotify.com/v1/me').max_retries
+
+        # urllib3 must not sleep on Retry-After itself, but still retries server errors
+        self.assertFalse(retry.is_retry('GET', 429, has_retry_after=True))
+        self.assertTrue(retry.is_retry('GET', 503, has_retry_after=False))
+        # Log lines and RetryError messages name the API method, not the wrapper
+        self.assertEqual(sp.playlist_items.__name__, 'playlist_items')
+
+    @patch('common_utils.time.sleep')
+    def test_retry_policy_fails_fast_on_fatal_errors(self, mock_sleep):
+        import spotipy
+        policy = RetryPolicy()
+        not_found = spotipy.exceptions.SpotifyException(404, -1, 'Invalid playlist Id')
+        func = MagicMock(side_effect=not_found, __name__='playlist')
+
+        with self.assertRaises(RetryError) as ctx:
+            policy.call(func, 'bad-id')
+
+        self.assertIs(ctx.exception.__cause__, not_found)
+        func.assert_called_once()
+        mock_sleep.assert_not_called()
+        self.assertEqual(policy.metrics['failures'], 1)
+
+    @patch('common_utils.time.sleep')
+    def test_retry_policy_retries_transient_errors_within_budget(self, mock_sleep):
+        policy = RetryPolicy(base_delay=1, max_delay=4, call_budget=60)
+        func = MagicMock(side_effect=[ConnectionResetError('reset'), TimeoutError('slow'), 'ok'], __name__='next')
+
+        self.assertEqual(policy.call(func), 'ok')
+        self.assertEqual(policy.metrics['retries'], 2)
+        for call in mock_sleep.call_args_list:
+            self.assertTrue(1 <= call[0][0] <= 4)
+        self.assertAlmostEqual(policy.metrics['sleep_seconds'], sum(c[0][0] for c in mock_sleep.call_args_list))
+
+        # An exhausted cycle budget stops further sleeping
+        policy.cycle_budget = 0
+        policy.start_cycle()
+        func.side_effect = ConnectionResetError('reset')
+        with self.assertRaises(RetryError):
+            policy.call(func)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch('common_utils.random.uniform', return_value=3)
+    @patch('common_utils.time.sleep')
+    def test_retry_policy_cycle_budget_counts_time_slept(self, mock_sleep, _):
+        policy = RetryPolicy(base_delay=1, max_delay=4, call_budget=60, cycle_budget=5)
+        func = MagicMock(side_effect=ConnectionResetError('reset'), __name__='next')
+
+        # The first 3s sleep fits the budget; a second one would bring the cycle to 6s
+        with self.assertRaises(RetryError):
+            policy.call(func)
+        mock_sleep.assert_called_once_with(3)
+        self.assertEqual(policy.metrics['sleep_seconds'], 3)
+
+    def test_normalization_handles_ascii_and_unicode(self):
+        self.assertEqual(normalize_for_matching('AC/DC - Highway_to.Hell (Live) [Remastered]'), 'acdc highwaytohell live remastered')
+        self.assertEqual(normalize_for_matching("Motörhead - Ace Of Spades ('80)"), 'motörhead ace of spades 80')
+        self.assertEqual(normalize_for_matching(None), '')
+        self.assertEqual(sanitizeFilename(' AC/DC: Who? '), 'AC_DC_ Who_')
+        self.assertEqual(sanitizeFilename('Björk: "Army of Me"'), 'Björk_ _Army of Me_')
+
+    def test_changed_playlists_detected_from_user_listing(self):
+        sp = MagicMock()
+        sp.user_playlists.return_value = {
+            'items': [
+                {'id': 'same', 'name': 'Same', 'snapshot_id': 's1', 'owner': {'id': 'username'}},
+                {'id': 'edited', 'name': 'Edited', 'snapshot_id': 'new', 'owner': {'id': 'username'}},
+                {'id': 'added', 'name': 'Added', 'snapshot_id': 'a1', 'owner': {'id': 'username'}},
+                {'id': 'followed', 'name': 'Followed', 'snapshot_id': 'f1', 'owner': {'id': 'someone'}},
+            ],
+            'next': None,
+        }
+        cached = [
+            {'id': 'same', 'name': 'Same', 'snapshot_id': 's1'},
+            {'id': 'edited', 'name': 'Edited', 'snapshot_id': 'old'},
+        ]
+
+        changed = get_changed_playlist_ids(sp, [{'user': 'username'}], cached)
+
+        self.assertEqual(changed, ['edited', 'added'])
+        sp.playlist.assert_not_called()
+
+    def test_user_playlists_only_fetches_requested_ids(self):
+        sp = MagicMock()
+        metadata = [
+            {'id': 'a', 'name': 'A', 'snapshot_id': '1', 'tracks_total': 10},
+            {'id': 'b', 'name': 'B', 'snapshot_id': '2', 'tracks_total': 20},
+        ]
+
+        playlists = getSpotifyUserPlaylists(sp, 'username', only_ids=['b'], metadata=metadata)
+
+        self.assertEqual(len(playlists), 1)
+        sp.user_playlist.assert_called_once_with('username', 'b')
+        sp.user_playlists.assert_not_called()
+
+    def test_cache_round_trip_keeps_only_used_fields(self):
+        playlist = {
+            'id': 'p1', 'name': 'Chill', 'snapshot_id': 's1',
+            'images': [{'url': 'https://example.com/cover.jpg'}],
+            'tracks': {'items': [{'added_at': '2024-01-01', 'track': {
+                'id': 't1', 'name': 'A Walk', 'uri': 'spotify:track:t1', 'available_markets': ['US'],
+                'artists': [{'name': 'Tycho', 'id': 'a1'}], 'album': {'name': 'Dive', 'images': []}}}],
+                'next': None, 'total': 1},
+            'local_tracks': {'t1': '/music/Chill/Tycho/Dive/Tycho - A Walk.flac'},
+        }
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch('utils.CACHE_FILE', os.path.join(cache_dir, 'cache.jsonl')):
+            save_cached_playlists([playlist])
+            cached = load_cached_playlists()
+
+        self.assertEqual(len(cached), 1)
+        self.assertNotIn('images', cached[0])
+        self.assertEqual(cached[0]['tracks']['items'][0]['track']['artists'], [{'name': 'Tycho'}])
+        self.assertEqual(cached[0]['local_tracks'], playlist['local_tracks'])
+
+class TestLibraryIndex(unittest.TestCase):
+
+    @patch('library_index.mutagen.File', return_value=None)
+    def test_refresh_only_reads_changed_files(self, mock_mutagen):
+        with tempfile.TemporaryDirectory() as music_path:
+            album = os.path.join(music_path, 'Playlist', 'AC_DC', 'Back In Black')
+            os.makedirs(album)
+            open(os.path.join(album, 'AC_DC - Hells Bells.mp3'), 'wb').close()
+
+            index = LibraryIndex(os.path.join(music_path, 'index.sqlite'))
+            index.refresh(music_path)
+            index.refresh(music_path)
+
+            self.assertEqual(mock_mutagen.call_count, 1)
+            self.assertIsNotNone(index.find_by_title(album, 'Hells Bells'))
+            self.assertIsNone(index.find_by_title(album, 'Shoot to Thrill'))
+
+            # A reopened index keeps its entries without rescanning
+            reopened = LibraryIndex(os.path.join(music_path, 'index.sqlite'))
+            self.assertIsNotNone(reopened.find_by_title(album, 'HELLS BELLS'))
+
+    def test_directory_snapshot_is_reused_until_invalidated(self):
+        with tempfile.TemporaryDirectory() as folder:
+            snapshots = DirectorySnapshotCache()
+            self.assertEqual(snapshots.filenames(folder), set())
+
+            open(os.path.join(folder, 'Kyuss - Thumb.flac'), 'wb').close()
+            self.assertEqual(snapshots.filenames(folder), set())
+
+            snapshots.invalidate(folder)
+            self.assertEqual(snapshots.filenames(folder), {'Kyuss - Thumb.flac'})
+
+class TestLibraryWatcher(unittest.TestCase):
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, 'library watcher did not catch up')
+            time.sleep(0.02)
+
+    @patch('library_index.mutagen.File', return_value=None)
+    def test_inotify_keeps_index_current(self, mock_mutagen):
+        with tempfile.TemporaryDirectory() as music_path:
+            index = LibraryIndex(':memory:')
+            try:
+                watcher = InotifyWatcher(music_path, index)
+            except OSError as e:
+                self.skipTest(f'inotify unavailable: {e}')
+            watcher.start()
+            try:
+                self.wait_for(lambda: index.watched)
+                # A new album folder is watched as soon as it appears
+                album = os.path.join(music_path, 'Stoner', 'Kyuss', 'Blues for the Red Sun')
+                os.makedirs(album)
+                thumb = os.path.join(album, 'Kyuss - Thumb.flac')
+                self.wait_for(lambda: any(p == album for p in watcher._paths.values()))
+                with open(thumb, 'wb') as f:
+                    f.write(b'audio')
+                self.wait_for(lambda: index.contains(thumb))
+
+                renamed = os.path.join(album, 'Kyuss - Green Machine.flac')
+                os.rename(thumb, renamed)
+                self.wait_for(lambda: index.contains(renamed) and not index.contains(thumb))
+
+                shutil.rmtree(os.path.join(music_path, 'Stoner'))
+                self.wait_for(lambda: not index.contains(renamed))
+            finally:
+                watcher.stop()
+            self.assertFalse(index.watched)
+
+    @patch('library_index.mutagen.File', return_value=None)
+    def test_polling_sees_changes_made_during_a_cycle(self, mock_mutagen):
+        with tempfile.TemporaryDirectory() as music_path:
+            album = os.path.join(music_path, 'Stoner', 'Kyuss', 'Blues for the Red Sun')
+            os.makedirs(album)
+            snapshots = DirectorySnapshotCache()
+            index = LibraryIndex(':memory:', snapshots=snapshots)
+            watcher = PollingWatcher(music_path, index)
+            self.assertEqual(watcher.rescan(), 0)
+
+            # The cycle's cached (now stale) listing doesn't hide the new file from the poll
+            snapshots.get(album)
+            open(os.path.join(album, 'Kyuss - Thumb.flac'), 'wb').close()
+            self.assertEqual(watcher.rescan(), 1)
+            self.assertIsNotNone(index.find_by_title(album, 'Thumb'))
+
+class TestSearchCache(unittest.TestCase):
+
+    @patch('search_cache.time.time')
+    def test_negative_results_expire_before_positive(self, mock_time):
+        cache = SearchCache(':memory:', positive_ttl=1000, negative_ttl=10, max_entries=10)
+        mock_time.return_value = 0
+        cache.put('t1', 'Kyuss - Thumb', 'https://www.youtube.com/watch?v=abc')
+        cache.put('t2', 'Kyuss - Unknown', None)
+
+        mock_time.return_value = 60
+        self.assertEqual(cache.get('t1', 'Kyuss - Thumb'), (True, 'https://www.youtube.com/watch?v=abc'))
+        self.assertEqual(cache.get('t2', 'Kyuss - Unknown'), (False, None))
+
+    @patch('search_cache.time.time')
+    def test_least_recently_used_entry_is_evicted(self, mock_time):
+        cache = SearchCache(':memory:', positive_ttl=1000, negative_ttl=1000, max_entries=2)
+        for now, track_id in enumerate(['a', 'b']):
+            mock_time.return_value = now
+            cache.put(track_id, track_id, f'https://www.youtube.com/watch?v={track_id}')
+        mock_time.return_value = 2
+        cache.get('a', 'a')
+        mock_time.return_value = 3
+        cache.put('c', 'c', 'https://www.youtube.com/watch?v=c')
+
+        self.assertTrue(cache.get('a', 'a')[0])
+        self.assertFalse(cache.get('b', 'b')[0])
+
+class FakeYoutubeDL:
+    """
+    Offline stand-in for yt_dlp.YoutubeDL: search returns fixed IDs and
+    downloads write an empty .webm file at the output template.
+    """
+    instances = []
+
+    def __init__(self, params):
+        self.params = params
+        self.downloads = []
+        FakeYoutubeDL.instances.append(self)
+
+    def extract_info(self, url, download=False):
+        return {'entries': [{'id': 'vid1'}, {'id': 'vid2'}]}
+
+    def download(self, urls):
+        self.downloads.extend(urls)
+        path = self.params['outtmpl']['default'].replace('%(ext)s', 'webm').replace('%%', '%')
+        open(path, 'wb').close()
+        return 0
+
+def fake_ffmpeg(fail_formats=()):
+    """
+    Returns a subprocess.run replacement that 'encodes' by creating the output file.
+    """
+    def run(cmd, **kwargs):
+        output_path = cmd[-1]
+        if output_path.rsplit('.', 1)[-1] in fail_formats:
+            return MagicMock(returncode=1, stderr='Unknown encoder')
+        open(output_path, 'wb').close()
+        return MagicMock(returncode=0, stderr='')
+    return run
+
+class TestYtDlpEngine(unittest.TestCase):
+
+    def setUp(self):
+        FakeYoutubeDL.instances = []
+
+    def test_instances_are_reused_across_calls(self):
+        with tempfile.TemporaryDirectory() as cache_path:
+            engine = YtDlpEngine(ffmpeg_location='/usr/bin/ffmpeg', ydl_factory=FakeYoutubeDL, cache_path=cache_path)
+
+            self.assertEqual(engine.search('Kyuss - Thumb'), ['vid1', 'vid2'])
+            for video_id in ['vid1', 'vid2']:
+                source = engine.fetch_audio(f'https://www.youtube.com/watch?v={video_id}', 'flac')
+                self.assertTrue(source.endswith('.webm'))
+                engine.discard(source)
+            self.assertEqual(os.listdir(cache_path), [])
+
+        # One search instance and one fetch instance, reused for both downloads
+        self.assertEqual(len(FakeYoutubeDL.instances), 2)
+        self.assertEqual(len(FakeYoutubeDL.instances[1].downloads), 2)
+        self.assertEqual(FakeYoutubeDL.instances[1].params['ffmpeg_location'], '/usr/bin/ffmpeg')
+
+    @patch('ytdlp_engine.subprocess.run', side_effect=fake_ffmpeg(fail_formats=('flac',)))
+    def test_mp3_fallback_reuses_fetched_audio(self, mock_run):
+        with tempfile.TemporaryDirectory() as folder:
+            engine = YtDlpEngine(ffmpeg_location='/usr/bin/ffmpeg', ydl_factory=FakeYoutubeDL, cache_path=os.path.join(folder, 'cache'))
+            source = engine.fetch_audio('https://www.youtube.com/watch?v=vid1', 'flac')
+
+            output_base = os.path.join(folder, '100% Kyuss - Thumb')
+            self.assertIsNone(engine.transcode(source, output_base, 'flac'))
+            self.assertEqual(engine.transcode(source, output_base, 'mp3', {'artist': 'Kyuss'}), output_base + '.mp3')
+
+        self.assertEqual(len(FakeYoutubeDL.instances[0].downloads), 1)
+        self.assertIn('artist=Kyuss', mock_run.call_args[0][0])
+
+class TestDeltaSync(unittest.TestCase):
+
+    @patch('library_index.mutagen.File', return_value=None)
+    @patch('plex_utils.search_youtube_for_track', return_value='https://www.youtube.com/watch?v=vid1')
+    @patch('plex_utils.downloadSpotifyTrack')
+    def test_only_added_tracks_are_processed(self, mock_download, mock_search, mock_mutagen):
+        def track(track_id, name):
+            return {'track': {'id': track_id, 'name': name, 'uri': f'spotify:track:{track_id}',
+                              'artists': [{'name': 'Kyuss'}], 'album': {'name': 'Blues for the Red Sun'}}}
+
+        with tempfile.TemporaryDirectory() as music_path:
+            album = os.path.join(music_path, 'Stoner', 'Kyuss', 'Blues for the Red Sun')
+            os.makedirs(album)
+            known_path = os.path.join(album, 'Kyuss - Thumb.flac')
+            open(known_path, 'wb').close()
+            mock_download.return_value = os.path.join(album, 'Kyuss - Green Machine.flac')
+
+            playlist = {
+                'name': 'Stoner',
+                'tracks': {'items': [track('t1', 'Thumb'), track('t2', 'Green Machine')], 'next': None},
+                'local_tracks': {'t1': known_path, 'gone': known_path},
+            }
+            local_tracks = ensureLocalFiles(MagicMock(), playlist, RuntimeConfig(music_path=music_path))
+
+            mock_download.assert_called_once()
+            self.assertEqual(mock_download.call_args[0][0], 'spotify:track:t2')
+            # The URL resolved in the search phase is handed to the download phase
+            mock_search.assert_called_once_with('Kyuss', 'Green Machine', 't2')
+            self.assertEqual(mock_download.call_args[0][5], 'https://www.youtube.com/watch?v=vid1')
+            self.assertEqual(set(local_tracks), {'t1', 't2'})
+
+    @patch('library_index.mutagen.File', return_value=None)
+    @patch('plex_utils.search_youtube_for_track', return_value='https://www.youtube.com/watch?v=vid1')
+    @patch('plex_utils.downloadSpotifyTrack')
+    def test_renamed_playlist_is_checked_in_its_new_folder(self, mock_download, mock_search, mock_mutagen):
+        def download(uri, folder, name, artist, expected_filepath, youtube_url, config):
+            open(expected_filepath, 'wb').close()
+            return expected_filepath
+        mock_download.side_effect = download
+
+        with tempfile.TemporaryDirectory() as music_path:
+            config = RuntimeConfig(music_path=music_path, prefer_flac=True)
+            playlist = {'name': 'Stoner', 'tracks': {'items': [{'track': {
+                'id': 't1', 'name': 'Thumb', 'uri': 'spotify:track:t1',
+                'artists': [{'name': 'Kyuss'}], 'album': {'name': 'Blues for the Red Sun'}}}], 'next': None}}
+            old_path = ensureLocalFiles(MagicMock(), playlist, config)['t1']
+
+            # Renamed on Spotify, old folder deleted
+            shutil.rmtree(os.path.join(music_path, 'Stoner'))
+            playlist['name'] = 'Desert'
+            local_tracks = ensureLocalFiles(MagicMock(), playlist, config)
+
+            # Populated from the shared track store rather than downloaded again
+            mock_download.assert_called_once()
+            self.assertNotEqual(local_tracks['t1'], old_path)
+            self.assertTrue(local_tracks['t1'].startswith(os.path.join(music_path, 'Desert', '')))
+            self.assertTrue(os.path.exists(local_tracks['t1']))
+
+    @patch('library_index.mutagen.File', return_value=None)
+    @patch('plex_utils.search_youtube_for_track', return_value='https://www.youtube.com/watch?v=vid1')
+    @patch('plex_utils.downloadSpotifyTrack')
+    def test_downloads_start_before_paging_finishes(self, mock_download, mock_search, mock_mutagen):
+        first_download = threading.Event()
+        mock_download.side_effect = lambda uri, folder, *args: first_download.set() or os.path.join(folder, 'x.flac')
+
+        def next_page(page):
+            # The second page is only served once the first missing track is downloading
+            self.assertTrue(first_download.wait(5))
+            return {'items': [{'track': {'id': 't2', 'name': 'Thumb', 'uri': 'spotify:track:t2',
+                                         'artists': [{'name': 'Kyuss'}], 'album': {'name': 'Welcome to Sky Valley'}}}],
+                    'next': None}
+
+        sp = MagicMock()
+        sp.next.side_effect = next_page
+        with tempfile.TemporaryDirectory() as music_path:
+            playlist = {
+                'name': 'Stoner',
+                'tracks': {'items': [{'track': {'id': 't1', 'name': 'Green Machine', 'uri': 'spotify:track:t1',
+                                                'artists': [{'name': 'Kyuss'}], 'album': {'name': 'Blues for the Red Sun'}}}],
+                           'next': 'page-2'},
+            }
+            local_tracks = ensureLocalFiles(sp, playlist, RuntimeConfig(music_path=music_path))
+
+        self.assertEqual(set(local_tracks), {'t1', 't2'})
+        self.assertEqual(playlist['tracks']['total'], 2)
+
+    @patch('library_index.mutagen.File', return_value=None)
+    @patch('plex_utils.search_youtube_for_track', return_value='https://www.youtube.com/watch?v=vid1')
+    @patch('plex_utils.downloadSpotifyTrack')
+    def test_folders_are_only_created_for_downloads(self, mock_download, mock_search, mock_mutagen):
+        def track(track_id, name, album):
+            return {'track': {'id': track_id, 'name': name, 'uri': f'spotify:track:{track_id}',
+                              'artists': [{'name': 'Kyuss'}], 'album': {'name': album}}}
+
+        def download(uri, folder, name, artist, expected_filepath, youtube_url, config):
+            self.assertTrue(os.path.isdir(folder))
+            open(expected_filepath, 'wb').close()
+            return expected_filepath
+        mock_download.side_effect = download
+
+        with tempfile.TemporaryDirectory() as music_path, \
+             patch.dict(os.environ, {'PREFER_FLAC': 'true'}), \
+             patch('plex_utils.createFolder', wraps=os.makedirs) as mock_create:
+            present = os.path.join(music_path, 'Stoner', 'Kyuss', 'Blues for the Red Sun')
+            os.makedirs(present)
+            open(os.path.join(present, 'Kyuss - Thumb.mp3'), 'wb').close()
+            config = RuntimeConfig(music_path=music_path, prefer_flac=False)
+
+            playlist = {'name': 'Stoner', 'tracks': {'items': [
+                track('t1', 'Thumb', 'Blues for the Red Sun'),
+                track('t2', 'Gardenia', 'Welcome to Sky Valley'),
+            ], 'next': None}}
+            local_tracks = ensureLocalFiles(MagicMock(), playlist, config)
+
+        # Only the queued download's folder is created, and the config (not the environment) picks the format
+        mock_create.assert_called_once_with(os.path.join(music_path, 'Stoner', 'Kyuss', 'Welcome to Sky Valley'))
+        self.assertTrue(local_tracks['t2'].endswith('Kyuss - Gardenia.mp3'))
+        self.assertIs(mock_download.call_args[0][6], config)
+
+    def test_runtime_config_from_env(self):
+        config = RuntimeConfig.from_env({'MUSIC_PATH': '/music', 'PREFER_FLAC': 'no', 'LOG_LEVEL': 'debug'})
+        self.assertEqual((config.music_path, config.audio_format, config.spotdl_log_level), ('/music', 'mp3', 'DEBUG'))
+        self.assertEqual(RuntimeConfig.from_env({'SPOTDL_LOG_LEVEL': 'error'}).audio_format, 'flac')
+        with self.assertRaises(AttributeError):
+            config.prefer_flac = True
+
+class TestContentStore(unittest.TestCase):
+
+    def test_track_is_linked_into_other_playlists(self):
+        with tempfile.TemporaryDirectory() as music_path:
+            store = ContentStore(os.path.join(music_path, '.plexify_store'))
+            first = os.path.join(music_path, 'Stoner', 'Kyuss', 'Blues for the Red Sun', 'Kyuss - Thumb.mp3')
+            os.makedirs(os.path.dirname(first))
+            with open(first, 'wb') as f:
+                f.write(b'audio')
+
+            self.assertIsNone(store.materialize('4uLU6hMCjMI75M1A2tKUQC', first))
+            store.add('4uLU6hMCjMI75M1A2tKUQC', first)
+
+            # The expected extension follows the stored file
+            second = store.materialize('4uLU6hMCjMI75M1A2tKUQC', os.path.join(music_path, 'Desert', 'Kyuss', 'Blues', 'Kyuss - Thumb.flac'))
+            self.assertTrue(second.endswith('Kyuss - Thumb.mp3'))
+            with open(second, 'rb') as f:
+                self.assertEqual(f.read(), b'audio')
+            self.assertTrue(os.path.samefile(first, second))
+
+            store.discard('4uLU6hMCjMI75M1A2tKUQC')
+            self.assertIsNone(store.lookup('4uLU6hMCjMI75M1A2tKUQC'))
+            self.assertTrue(os.path.exists(second))
+
+    @patch('content_store._reflink', side_effect=OSError('not supported'))
+    @patch('content_store.os.link', side_effect=OSError('cross-device link'))
+    def test_store_only_keeps_hardlinks_or_reflinks(self, mock_link, mock_reflink):
+        with tempfile.TemporaryDirectory() as music_path:
+            store = ContentStore(os.path.join(music_path, '.plexify_store'))
+            first = os.path.join(music_path, 'Stoner', 'Kyuss - Thumb.mp3')
+            os.makedirs(os.path.dirname(first))
+            with open(first, 'wb') as f:
+                f.write(b'audio')
+
+            # No symlink or copy of the playlist file ends up in the store
+            store.add('4uLU6hMCjMI75M1A2tKUQC', first)
+            self.assertIsNone(store.lookup('4uLU6hMCjMI75M1A2tKUQC'))
+
+    def test_sweep_removes_unused_tracks(self):
+        with tempfile.TemporaryDirectory() as music_path:
+            store = ContentStore(os.path.join(music_path, '.plexify_store'))
+            folder = os.path.join(music_path, 'Stoner')
+            os.makedirs(folder)
+            for track_id in ('kept', 'deleted', 'referenced'):
+                path = os.path.join(folder, f'{track_id}.mp3')
+                with open(path, 'wb') as f:
+                    f.write(b'audio')
+                store.add(track_id, path)
+            # Deleted by hand, and one whose playlist copy is gone but that a playlist still lists
+            os.remove(os.path.join(folder, 'deleted.mp3'))
+            os.remove(os.path.join(folder, 'referenced.mp3'))
+
+            self.assertEqual(store.sweep({'referenced'}), 1)
+            self.assertIsNotNone(store.lookup('kept'))
+            self.assertIsNone(store.lookup('deleted'))
+            self.assertIsNotNone(store.lookup('referenced'))
+
+    def test_dangling_link_is_replaced(self):
+        with tempfile.TemporaryDirectory() as music_path:
+            store = ContentStore(os.path.join(music_path, '.plexify_store'))
+            first = os.path.join(music_path, 'Stoner', 'Kyuss - Thumb.mp3')
+            os.makedirs(os.path.dirname(first))
+            with open(first, 'wb') as f:
+                f.write(b'audio')
+            store.add('4uLU6hMCjMI75M1A2tKUQC', first)
+
+            second = os.path.join(music_path, 'Desert', 'Kyuss - Thumb.mp3')
+            os.makedirs(os.path.dirname(second))
+            os.symlink(os.path.join(music_path, 'gone.mp3'), second)
+
+            self.assertEqual(store.materialize('4uLU6hMCjMI75M1A2tKUQC', second), second)
+            with open(second, 'rb') as f:
+                self.assertEqual(f.read(), b'audio')
+
+class TestOneStarTracks(unittest.TestCase):
+
+    def test_rating_filter_runs_on_the_server(self):
+        plex = MagicMock()
+        rated = MagicMock(userRating=2.0, title='Thumb', grandparentTitle='Kyuss')
+        half_star = MagicMock(userRating=1.0, title='Gardenia', grandparentTitle='Kyuss')
+        plex.library.section.return_value.searchTracks.return_value = [rated, half_star]
+
+        tracks = get_one_star_tracks(plex, 'Stoner')
+
+        plex.library.section.assert_called_once_with('Stoner')
+        kwargs = plex.library.section.return_value.searchTracks.call_args.kwargs
+        self.assertEqual(kwargs['filters'], {'userRating>>': 0, 'userRating<<': 3})
+        self.assertEqual([(t['title'], t['artist']) for t in tracks], [('Thumb', 'Kyuss'), ('Gardenia', 'Kyuss')])
+        # No per-track artist lookups
+        rated.artist.assert_not_called()
+
+    def test_track_match_index_covers_all_pages(self):
+        def item(track_id, name, *artists):
+            return {'track': {'id': track_id, 'name': name, 'artists': [{'name': a} for a in artists]}}
+
+        sp = MagicMock()
+        sp.playlist_items.return_value = {'items': [item(f't{i}', f'Song {i}', 'Band') for i in range(100)], 'next': 'page-2'}
+        sp.next.return_value = {'items': [item('t100', 'Highway to Hell', 'AC/DC', 'Bon Scott')], 'next': None}
+
+        index = buildTrackMatchIndex(getSpotifyPlaylistTracks(sp, 'p1'))
+
+        self.assertEqual(len(index), 102)
+        self.assertEqual(index[('highway to hell', 'acdc')], 't100')
+        self.assertEqual(index[('highway to hell', 'bon scott')], 't100')
+
+    @patch('common_utils.time.sleep')
+    def test_removals_are_batched_with_per_track_failures(self, mock_sleep):
+        import spotipy
+        track_ids = [f't{i}' for i in range(150)]
+
+        def remove(playlist_id, items):
+            if 'bad' in items:
+                if len(items) == 1:
+                    raise spotipy.exceptions.SpotifyException(400, -1, 'Invalid track uri')
+                raise spotipy.exceptions.SpotifyException(400, -1, 'Invalid track uri in batch')
+            return {'snapshot_id': f'snap-{len(items)}'}
+
+        sp = MagicMock()
+        sp.playlist_remove_all_occurrences_of_items.side_effect = remove
+        sp.playlist.return_value = {'snapshot_id': 'old'}
+        removed, failed, snapshot_id = removeTracksFromPlaylist(sp, 'p1', track_ids + ['bad'], 'old')
+
+        # 100 + 51 in two batches; the rejected batch is retried track by track
+        self.assertEqual(len(removed), 150)
+        self.assertEqual(list(failed), ['bad'])
+        self.assertEqual(sp.playlist_remove_all_occurrences_of_items.call_count, 2 + 51)
+        self.assertEqual(snapshot_id, 'snap-1')
+
+        playlist = {'snapshot_id': 'old', 'tracks': {'items': [{'track': {'id': 't1'}}, {'track': {'id': 'keep'}}], 'total': 2},
+                    'local_tracks': {'t1': '/music/a.flac', 'keep': '/music/b.flac'}}
+        forgetPlaylistTracks(playlist, removed, snapshot_id)
+        self.assertEqual(playlist['snapshot_id'], 'snap-1')
+        self.assertEqual(playlist['tracks']['items'], [{'track': {'id': 'keep'}}])
+        self.assertEqual(playlist['local_tracks'], {'keep': '/music/b.flac'})
+
+    def test_low_rated_tracks_are_grouped_by_section(self):
+        plex = MagicMock()
+        stoner = MagicMock(key='3', type='artist')
+        stoner.title = 'Stoner'
+        plex.library.sections.return_value = [stoner]
+        plex.fetchItems.return_value = [
+            MagicMock(userRating=2.0, title='Thumb', grandparentTitle='Kyuss', librarySectionTitle='Stoner'),
+            MagicMock(userRating=1.0, title='Gardenia', grandparentTitle='Kyuss', librarySectionTitle=None, librarySectionID=3),
+            MagicMock(userRating=2.0, title='Paranoid', grandparentTitle='Black Sabbath', librarySectionTitle='Doom')]
+
+        by_section = get_low_rated_tracks_by_section(plex)
+        get_low_rated_tracks_by_section(plex)
+
+        self.assertEqual({title: [t['title'] for t in tracks] for title, tracks in by_section.items()},
+                         {'Stoner': ['Thumb', 'Gardenia'], 'Doom': ['Paranoid']})
+        self.assertIn('userRating<<=3', plex.fetchItems.call_args[0][0])
+        # The section listing is cached between cycles
+        plex.library.sections.assert_called_once()
+
+    def test_idle_cleanup_makes_no_spotify_calls(self):
+        from main import process_one_star_deletions
+        plex, sp = MagicMock(), MagicMock()
+        plex.fetchItems.return_value = []
+
+        self.assertFalse(process_one_star_deletions(plex, sp, [{'id': 'p1', 'name': 'Stoner'}]))
+
+        self.assertEqual(sp.mock_calls, [])
+        plex.library.section.assert_not_called()
+
+    @patch('main.delete_plex_track')
+    def test_cleanup_matches_against_cached_tracks(self, mock_delete):
+        from main import process_one_star_deletions
+        plex, sp = MagicMock(), MagicMock()
+        plex.fetchItems.return_value = [
+            MagicMock(userRating=2.0, title='Thumb', grandparentTitle='Kyuss', librarySectionTitle='Stoner'),
+            MagicMock(userRating=2.0, title='Paranoid', grandparentTitle='Black Sabbath', librarySectionTitle='Doom')]
+        sp.playlist_remove_all_occurrences_of_items.return_value = {'snapshot_id': 'new'}
+        sp.playlist.return_value = {'snapshot_id': 'old'}
+        playlist = {'id': 'p1', 'name': 'Stoner', 'snapshot_id': 'old',
+                    'tracks': {'items': [{'track': {'id': 't1', 'name': 'Thumb', 'artists': [{'name': 'Kyuss'}]}}], 'next': None}}
+
+        self.assertTrue(process_one_star_deletions(plex, sp, [playlist]))
+
+        sp.playlist.assert_called_once_with('p1', fields='snapshot_id')
+        sp.playlist_items.assert_not_called()
+        plex.library.section.assert_not_called()
+        plex.fetchItems.assert_called_once()
+        sp.playlist_remove_all_occurrences_of_items.assert_called_once_with('p1', ['t1'])
+        mock_delete.assert_called_once()
+        self.assertEqual(playlist['snapshot_id'], 'new')
+
+    def test_removal_keeps_snapshot_of_a_playlist_edited_since_caching(self):
+        sp = MagicMock()
+        sp.playlist.return_value = {'snapshot_id': 'edited'}
+        sp.playlist_remove_all_occurrences_of_items.return_value = {'snapshot_id': 'new'}
+        playlist = {'id': 'p1', 'snapshot_id': 'old', 'tracks': {'items': [{'track': {'id': 't1'}}], 'total': 1}}
+
+        removed, failed, snapshot_id = removeTracksFromPlaylist(sp, 'p1', ['t1'], playlist['snapshot_id'])
+        forgetPlaylistTracks(playlist, removed, snapshot_id)
+
+        # The new snapshot would hide the unsynced edits, so the next check must still refetch
+        self.assertEqual(removed, ['t1'])
+        self.assertIsNone(snapshot_id)
+        self.assertEqual(playlist['snapshot_id'], 'old')
+        self.assertEqual(playlist['tracks']['items'], [])
+
+    def test_cleanup_deletes_with_the_given_worker_count(self):
+        from main import process_one_star_deletions
+        plex, sp = MagicMock(), MagicMock()
+        low_rated = {'Stoner': [{'title': f'Track {i}', 'artist': 'Kyuss', 'plex_track': MagicMock()} for i in range(4)]}
+        active, peak = [0], [0]
+        lock = threading.Lock()
+
+        def delete(plex_track, playlist_name):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+
+        playlist = {'id': 'p1', 'name': 'Stoner', 'tracks': {'items': [], 'next': None}}
+        with patch('main.delete_plex_track', side_effect=delete) as mock_delete:
+            process_one_star_deletions(plex, sp, [playlist], low_rated, delete_workers=1)
+
+        self.assertEqual(mock_delete.call_count, 4)
+        self.assertEqual(peak[0], 1)
+
+    @patch('main.delete_plex_track')
+    def test_read_only_cleanup_still_deletes_from_plex(self, mock_delete):
+        import spotipy
+        from main import process_one_star_deletions
+        plex, sp = MagicMock(), MagicMock()
+        plex.fetchItems.return_value = [
+            MagicMock(userRating=2.0, title='Thumb', grandparentTitle='Kyuss', librarySectionTitle='Stoner'),
+            MagicMock(userRating=2.0, title='Gardenia', grandparentTitle='Kyuss', librarySectionTitle='Stoner')]
+        sp.playlist_remove_all_occurrences_of_items.side_effect = spotipy.exceptions.SpotifyException(403, -1, 'Forbidden')
+        playlist = {'id': 'p1', 'name': 'Stoner', 'snapshot_id': 'old',
+                    'tracks': {'items': [{'track': {'id': 't1', 'name': 'Thumb', 'artists': [{'name': 'Kyuss'}]}},
+                                         {'track': {'id': 't2', 'name': 'Gardenia', 'artists': [{'name': 'Kyuss'}]}}], 'next': None}}
+
+        self.assertFalse(process_one_star_deletions(plex, sp, [playlist]))
+
+        # One rejected batch, no per-track retries, and Plex is cleaned up anyway
+        sp.playlist_remove_all_occurrences_of_items.assert_called_once_with('p1', ['t1', 't2'])
+        self.assertEqual(mock_delete.call_count, 2)
+        self.assertEqual(playlist['snapshot_id'], 'old')
+
+class TestAsyncSync(unittest.TestCase):
+
+    @patch('async_sync.save_cached_playlists')
+    @patch('async_sync.search_queued_track', side_effect=lambda job: f'https://www.youtube.com/watch?v={job[0]}')
+    @patch('async_sync.fetchPlaylistTracks', return_value=[])
+    @patch('async_sync.refreshPlaylists')
+    def test_playlists_progress_concurrently(self, mock_refresh, mock_fetch, mock_search, mock_save):
+        playlists = [{'id': 'p1', 'name': 'Stoner'}, {'id': 'p2', 'name': 'Doom'}]
+        mock_refresh.return_value = playlists
+        # Both playlists must be downloading at the same time to get past the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        plex_calls = []
+
+        def plan(music_path, playlist, tracks, config):
+            job = (playlist['id'], f"/music/{playlist['name']}", 'Track', 'Artist', '/music/x.flac')
+            return MagicMock(), {}, [(playlist['id'] + '-t', job)]
+
+        def download(index, batch, store=None, config=None):
+            barrier.wait()
+            return [(track_id, f'/music/{track_id}.flac') for track_id, _, _ in batch]
+
+        with patch('async_sync.planLocalFiles', side_effect=plan), \
+             patch('async_sync._download_batch', side_effect=download):
+            async def run():
+                limits = StageLimits(spotify=1, search=1, download=2, plex=1)
+                return await runSyncAsync(MagicMock(), [{'user': 'username'}], plex_stage=plex_calls.append, limits=limits,
+                                          config=RuntimeConfig(music_path='/music'))
+            result = asyncio.run(run())
+
+        self.assertEqual(result, playlists)
+        self.assertEqual(playlists[0]['local_tracks'], {'p1-t': '/music/p1-t.flac'})
+        self.assertEqual(sorted(p['id'] for p in plex_calls), ['p1', 'p2'])
+        mock_save.assert_called_once_with(playlists)
+
+class TestSyncScheduler(unittest.TestCase):
+
+    @patch('sync_scheduler.time.monotonic')
+    def test_changed_uris_are_polled_more_often(self, mock_monotonic):
+        hot, cold = {'playlist': 'hot'}, {'user': 'username'}
+        mock_monotonic.return_value = 0
+        scheduler = SyncScheduler([hot, cold], base_interval=3600, min_interval=600, max_interval=14400)
+
+        def playlists(hot_snapshot):
+            return [{'id': 'hot', 'snapshot_id': hot_snapshot, 'source': 'spotify:playlist:hot'},
+                    {'id': 'p1', 'snapshot_id': 's1', 'source': 'spotify:user:username'}]
+
+        self.assertEqual(scheduler.pop_due(), [hot, cold])
+        scheduler.record([hot, cold], playlists('a'), api_calls=4)
+        self.assertEqual(scheduler.pop_due(), [])
+        self.assertEqual(scheduler.seconds_until_due(), 3600)
+
+        mock_monotonic.return_value = 3600
+        scheduler.record(scheduler.pop_due(), playlists('b'), api_calls=2)
+        self.assertEqual(scheduler.intervals, {'spotify:playlist:hot': 1800, 'spotify:user:username': 7200})
+
+        mock_monotonic.return_value = 5400
+        self.assertEqual(scheduler.pop_due(), [hot])
+
+    @patch('sync_scheduler.time.monotonic')
+    def test_hourly_budget_and_failures_delay_checks(self, mock_monotonic):
+        uri = {'playlist': 'p1'}
+        mock_monotonic.return_value = 0
+        scheduler = SyncScheduler([uri], base_interval=600, min_interval=600, hourly_budget=50)
+
+        scheduler.record(scheduler.pop_due(), [], api_calls=50)
+        mock_monotonic.return_value = 600
+        self.assertEqual(scheduler.pop_due(), [])
+        # Due, but the budget is spent until the round at t=0 leaves the one-hour window
+        self.assertEqual(scheduler.seconds_until_due(), 3000)
+
+        mock_monotonic.return_value = 3600
+        scheduler.record_failure(scheduler.pop_due())
+        mock_monotonic.return_value = 3660
+        scheduler.record_failure(scheduler.pop_due())
+        self.assertEqual(scheduler.seconds_until_due(), 120)
+
+    def test_change_detection_skips_playlists_of_other_uris(self):
+        sp = MagicMock()
+        sp.playlist.return_value = {'snapshot_id': 'new'}
+        cached = [
+            {'id': 'due', 'name': 'Due', 'snapshot_id': 'old', 'source': 'spotify:playlist:due'},
+            {'id': 'later', 'name': 'Later', 'snapshot_id': 'old', 'source': 'spotify:playlist:later'},
+        ]
+
+        changed = get_changed_playlist_ids(sp, [{'playlist': 'due'}], cached)
+
+        self.assertEqual(changed, ['due'])
+        sp.playlist.assert_called_once_with('due', fields='snapshot_id')
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file